@@ -0,0 +1,4 @@
+"""Benchmarks of parking and broadcast hot paths.
+
+Run `python3 -m benchmarks --help` for options.
+"""
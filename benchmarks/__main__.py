@@ -0,0 +1,259 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from importlib import import_module
+from json import dump
+from os.path import join
+from platform import python_version
+from random import Random
+from subprocess import run
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+from structures.parking import PLACE_SIGNS, Parking, PlaceSnapshot
+from structures.stats import Stats
+
+from .fakes import FakeBot, make_context, make_update, user_name
+
+BENCHMARKS = ('parking_handler', 'cancel_handler', 'clear_handler',
+              'statistics_handler', 'make_keyboard', 'stats_count')
+"""tuple: benchmark names."""
+
+CONTROLS = ('cancel', 'clear', 'statistics', 'lot', 'page')
+"""tuple: callback data prefixes of not place buttons."""
+
+
+def load_bot(directory: str, edit_messages: bool, coalesce: float = 0):
+    """Import bot with config in directory and no rate limits."""
+    config = {
+        'broadcast': {'chat_rate': 1e9, 'rate': 1e9, 'workers': 8},
+        'coalesce': {'window': coalesce},
+        'data_file': join(directory, 'data.sqlite3'),
+        'edit_messages': edit_messages,
+        'logging': {'log_file': join(directory, 'log.txt'),
+                    'log_length': '10'},
+        'owner_id': 0,
+        'places': [],
+        'token': '',
+        'users_file': join(directory, 'users.json'),
+        'whitelist': False,
+    }
+    for filename, data in ((join(directory, 'config.json'), config),
+                           (config['users_file'], {})):
+        with open(filename, 'w') as file:
+            dump(data, file)
+    bot_module = import_module('parking_bot')
+    bot_module.setup(join(directory, 'config.json'))
+    return bot_module
+
+
+class Scenario:
+    """Parking with users and fake bot for one benchmark run.
+
+    Attributes:
+        bot_module: imported parking_bot.
+        places: number of places.
+        users: number of users.
+        seed: random seed.
+    """
+    def __init__(self, bot_module, places: int, users: int,
+                 seed: int) -> None:
+        self.bot_module = bot_module
+        self.random = Random(seed)
+        self.users = list(range(1, users + 1))
+        bot_module.users.clear()
+        bot_module.users.update(
+            {str(user): user_name(user) for user in self.users})
+        bot_module.keyboard_cache.clear()
+        self.fake = FakeBot()
+        # Config of benchmarks has no lots, so there is single lot ""
+        self.bot_data = {
+            'parking': {'': Parking([str(num)
+                                     for num in range(1, places + 1)])},
+            'stats': {'': Stats(bot_module.users)},
+            'messages': {},
+            'subscribers': {'': {'all': set(bot_module.users)}},
+        }
+
+    def press(self, user: int, data: str) -> None:
+        """Press button with callback data as user."""
+        update = make_update(self.fake, user, data)
+        for handler in self.bot_module.handlers:
+            check = handler.check_update(update)
+            if check:
+                args = check[0] if isinstance(check, tuple) else None
+                context = make_context(self.fake, self.bot_data, args)
+                handler.callback(update, context)
+                return
+        raise ValueError(data)
+
+    def buttons(self, user: int) -> list:
+        """Callback data and captions of user's keyboard buttons."""
+        markup = self.bot_module.make_keyboard(
+            make_context(self.fake, self.bot_data), '', str(user))
+        return [(button.callback_data, button.text)
+                for row in markup.inline_keyboard for button in row]
+
+    def place_buttons(self, user: int, state: str = None) -> list:
+        """Callback data of place buttons, optionally in given state."""
+        return [data for data, text in self.buttons(user)
+                if not data.startswith(CONTROLS)
+                and (state is None or text.startswith(PLACE_SIGNS[state]))]
+
+    def control_button(self, user: int, prefix: str) -> str:
+        for data, _ in self.buttons(user):
+            if data.startswith(prefix):
+                return data
+        return None
+
+    def occupy(self, count: int) -> None:
+        """Reserve and occupy random free places by random users."""
+        for _ in range(count):
+            user = self.random.choice(self.users)
+            free = self.place_buttons(user, 'free')
+            if not free:
+                return
+            self.press(user, self.random.choice(free))
+            data = self.random.choice(self.place_buttons(user, 'reserved'))
+            self.press(user, data)
+
+
+def measure(scenario: Scenario, name: str, events: int) -> list:
+    """Run benchmark, returns latencies of operations in seconds."""
+    latencies = []
+    random = scenario.random
+    stats = scenario.bot_data['stats']['']
+    for _ in range(events):
+        user = random.choice(scenario.users)
+        if name == 'parking_handler':
+            data = random.choice(scenario.place_buttons(user))
+        elif name == 'cancel_handler':
+            free = scenario.place_buttons(user, 'free')
+            if not free:
+                scenario.press(user, scenario.control_button(user, 'clear'))
+                free = scenario.place_buttons(user, 'free')
+            scenario.press(user, random.choice(free))
+            data = scenario.control_button(user, 'cancel')
+        elif name == 'clear_handler':
+            scenario.occupy(max(1, len(scenario.place_buttons(user)) // 4))
+            data = scenario.control_button(user, 'clear')
+        elif name == 'statistics_handler':
+            data = scenario.control_button(user, 'statistics')
+        elif name == 'make_keyboard':
+            scenario.occupy(1)
+            context = make_context(scenario.fake, scenario.bot_data)
+            for user in scenario.users:
+                begin = perf_counter()
+                scenario.bot_module.make_keyboard(context, '', str(user))
+                latencies.append(perf_counter() - begin)
+            continue
+        elif name == 'stats_count':
+            number = random.choice(
+                scenario.bot_data['parking'][''].places).number
+            place = PlaceSnapshot(number, random.choice(
+                ('reserved', 'occupied')), str(user),
+                datetime.now() - timedelta(hours=1))
+            begin = perf_counter()
+            stats.count(place)
+            latencies.append(perf_counter() - begin)
+            continue
+        begin = perf_counter()
+        scenario.press(user, data)
+        latencies.append(perf_counter() - begin)
+    return latencies
+
+
+def benchmark(bot_module, name: str, places: int, users: int, events: int,
+              seed: int, memory: bool) -> dict:
+    """Run benchmark at scale and collect results."""
+    scenario = Scenario(bot_module, places, users, seed)
+    broadcaster = bot_module.broadcaster
+    broadcaster.start(scenario.fake)
+    bot_module.coalescer.start()
+    if memory:
+        start()
+    begin = perf_counter()
+    latencies = measure(scenario, name, events)
+    bot_module.coalescer.stop()
+    broadcaster.stop()
+    seconds = perf_counter() - begin
+    peak = 0
+    if memory:
+        peak = get_traced_memory()[1]
+        stop()
+    latencies.sort()
+    return {
+        'benchmark': name,
+        'places': places,
+        'users': users,
+        'operations': len(latencies),
+        'seconds': round(seconds, 6),
+        'throughput': round(len(latencies) / seconds, 2),
+        'latency_ms': {
+            label: round(percentile(latencies, rank) * 1000, 4)
+            for label, rank in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99),
+                                ('max', 1.0))},
+        'calls': dict(scenario.fake.calls),
+        'calls_per_operation': round(
+            scenario.fake.total / max(1, len(latencies)), 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def percentile(values: list, rank: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(rank * len(values)))]
+
+
+def revision() -> str:
+    result = run(['git', 'rev-parse', '--short', 'HEAD'],
+                 capture_output=True, universal_newlines=True)
+    return result.stdout.strip() or None
+
+
+def main() -> None:
+    parser = ArgumentParser(prog='python3 -m benchmarks',
+                            description='Benchmarks of bot hot paths')
+    parser.add_argument('-b', '--benchmarks', nargs='+', default=BENCHMARKS,
+                        choices=BENCHMARKS, metavar='B',
+                        help='benchmarks to run')
+    parser.add_argument('-p', '--places', nargs='+', type=int,
+                        default=[10, 100], help='parking sizes')
+    parser.add_argument('-u', '--users', nargs='+', type=int,
+                        default=[10, 100], help='numbers of users')
+    parser.add_argument('-e', '--events', type=int, default=100,
+                        help='events per benchmark')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('-m', '--memory', action='store_true',
+                        help='trace peak memory (slower)')
+    parser.add_argument('--edit-messages', action='store_true',
+                        help='edit status messages in place')
+    parser.add_argument('--coalesce', type=float, default=0, metavar='S',
+                        help='coalescing window of notifications')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='results json file')
+    args = parser.parse_args()
+    results = []
+    with TemporaryDirectory() as directory:
+        bot_module = load_bot(directory, args.edit_messages,
+                              args.coalesce)
+        for name in args.benchmarks:
+            for places in args.places:
+                for users in args.users:
+                    result = benchmark(bot_module, name, places, users,
+                                       args.events, args.seed, args.memory)
+                    results.append(result)
+                    print(f'{name:<20} places {places:>5} users {users:>5} '
+                          f'{result["throughput"]:>10} op/s '
+                          f'p95 {result["latency_ms"]["p95"]:>9} ms '
+                          f'{result["calls_per_operation"]:>8} calls/op')
+    with open(args.output, 'w') as file:
+        dump({'revision': revision(), 'python': python_version(),
+              'date': datetime.now().isoformat(timespec='seconds'),
+              'arguments': vars(args), 'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
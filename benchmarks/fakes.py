@@ -0,0 +1,72 @@
+from collections import Counter
+from itertools import count
+from threading import Lock
+from types import SimpleNamespace
+
+from telegram import Update
+
+
+class FakeBot:
+    """Bot stand-in, which counts API calls instead of making them.
+
+    Every method returns message-like object with new message id.
+    """
+    defaults = None
+    username = 'parking_bot'
+
+    def __init__(self) -> None:
+        self.calls = Counter()
+        self.__ids = count(1)
+        self.__lock = Lock()
+
+    def __getattr__(self, method: str):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs) -> SimpleNamespace:
+            with self.__lock:
+                self.calls[method] += 1
+                message_id = next(self.__ids)
+            return SimpleNamespace(message_id=message_id,
+                                   chat_id=kwargs.get('chat_id'),
+                                   photo=[SimpleNamespace(file_id='photo')])
+        return call
+
+    @property
+    def total(self) -> int:
+        """Total API calls."""
+        return sum(self.calls.values())
+
+
+def make_update(bot: FakeBot, user_id: int, data: str = None,
+                text: str = None) -> Update:
+    """Update from user with callback data or message text.
+
+    Real `Update` is used, so handlers match it as in the bot, but all
+    replies go to fake bot.
+    """
+    user = {'id': user_id, 'is_bot': False, 'first_name': user_name(user_id),
+            'username': f'user{user_id}'}
+    message = {'message_id': 1, 'date': 0, 'from': user,
+               'chat': {'id': user_id, 'type': 'private'}}
+    if data is not None:
+        update = {'update_id': 1, 'callback_query': {
+            'id': '1', 'from': user, 'chat_instance': '1', 'data': data,
+            'message': message}}
+    else:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        update = {'update_id': 1, 'message': message}
+    return Update.de_json(update, bot)
+
+
+def make_context(bot: FakeBot, bot_data: dict,
+                 args: list = None) -> SimpleNamespace:
+    """CallbackContext stand-in."""
+    return SimpleNamespace(bot=bot, bot_data=bot_data, args=args or [])
+
+
+def user_name(user_id: int) -> str:
+    return f'User{user_id}'
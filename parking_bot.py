@@ -1,21 +1,55 @@
+import signal
 from argparse import ArgumentParser
-from json import dump, dumps, load, loads
-from logging import INFO, basicConfig, getLogger
-from subprocess import run
+from datetime import date, datetime, timedelta
+from functools import wraps
+from json import dumps, load
+from logging import INFO, Formatter, basicConfig, getLogger
+from logging.handlers import QueueHandler
+from math import ceil
+from os import getpid
+from queue import SimpleQueue
+from socket import gethostname
+from tempfile import TemporaryFile
+from threading import Event, Lock, Thread, local
+from time import perf_counter
+from typing import Callable
+from zlib import crc32
 
 from emoji import emojize
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.error import Unauthorized
+from telegram.error import BadRequest
 from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
-    PicklePersistence,
+    Filters,
+    MessageHandler,
     Updater,
 )
+from telegram.utils.helpers import escape_markdown
 
+from structures.broadcast import Broadcaster
+from structures.charts import available as charts_available
+from structures.charts import render_charts
+from structures.coalescer import Coalescer
+from structures.events import EventLog
+from structures.exchange import FORMATS, export_stats, import_stats, read_stats
+from structures.logs import (
+    BatchingFileHandler,
+    BatchingQueueListener,
+    JsonFormatter,
+    RingBufferHandler,
+    tail_rotated,
+)
+from structures.metrics import Metrics
 from structures.parking import Parking as Parking
+from structures.parking import PlaceSnapshot, StaleError
+from structures.persistence import SQLitePersistence, check_database
+from structures.scheduler import Scheduler
 from structures.stats import Stats as Stats
+from structures.store import SharedStore
+from structures.webhook import WebhookServer
+from structures.writer import JsonWriter
 
 
 def start(update: Update, context: CallbackContext) -> None:
@@ -25,15 +59,20 @@ def start(update: Update, context: CallbackContext) -> None:
         and str(update.effective_user.id) in users
         or not config["whitelist"]
     ):
+        unblock_user(str(update.effective_user.id))
         manage_user(update, context)
-        parking = context.bot_data["parking"]
-        markup = make_keyboard(context, str(update.effective_user.id))
         welcome = (
             r"Вас приветствует *Парковочный бот Logrocon*\!"
             + "\nВыберете место кнопками ниже"
         )
         update.effective_message.reply_text(welcome, parse_mode="MarkdownV2")
-        update.effective_message.reply_text(parking.state_text, reply_markup=markup)
+        lot = user_lot(context, str(update.effective_user.id))
+        if lot is None:
+            update.effective_message.reply_text(
+                "Выберите парковку", reply_markup=make_lots_keyboard(context)
+            )
+        else:
+            send_status(update, context, lot)
         log_event(update, "Отправил start")
 
 
@@ -51,6 +90,7 @@ def stop(update: Update, context: CallbackContext) -> None:
                 + " вернутся к их получению командой /start."
             )
             manage_user(update, context, False)
+            unsubscribe(context, str(update.effective_user.id))
         except KeyError:
             log_event(update, "Отправил stop повторно")
 
@@ -63,31 +103,45 @@ def parking_handler(update: Update, context: CallbackContext) -> None:
         or not config["whitelist"]
     ):
         manage_user(update, context)
-        number = update.callback_query.data
+        user_id = str(update.effective_user.id)
         try:
-            parking = context.bot_data["parking"]
-            stats = context.bot_data["stats"]
-            for place in parking.places:
-                if place.number == number:
-                    stats.count(place)
-                    place.toggle_state(str(update.effective_user.id))
-                    state = place.state
-            if state == "reserved":
-                action_text = "зарезервировал"
-            elif state == "occupied":
-                action_text = "занял"
-            elif state == "free":
-                action_text = "освободил"
-            update.callback_query.answer(f"Вы {action_text}и место {number}")
-            action = (
-                f"*{users[str(update.effective_user.id)]}* "
-                + f"{action_text} место *{number}*"
-            )
-            update_state(update, context, action)
-            log_event(update, action)
+            lot, number, version = parse_place_data(update.callback_query.data)
+            parking = get_parking(context, lot)
+            place, toggled = parking.toggle_state(number, user_id, version)
+            share_place(context, lot, toggled, version)
+        except StaleError:
+            update.callback_query.answer("Клавиатура устарела, отправили новую")
+            send_status(update, context, current_lot(context, user_id))
+            log_event(update, "Нажал на место на старой клавиатуре")
+            return
         except ValueError:
             update.callback_query.answer(f"Место {number} не свободно!")
-            log_event(update, f"Нажал на несвободное место {number}")
+            log_event(update, f"Нажал на несвободное место {number}", number)
+            return
+        count_place(context, lot, place, user=user_id)
+        if toggled.state == "reserved":
+            schedule_expiry(context, lot, toggled)
+            action_text = "зарезервировал"
+        elif toggled.state == "occupied":
+            scheduler.cancel(("reserve", lot, number))
+            action_text = "занял"
+        elif toggled.state == "free":
+            action_text = "освободил"
+        update.callback_query.answer(f"Вы {action_text}и место {number}")
+        action = (
+            f"*{users[str(update.effective_user.id)]}* "
+            + f"{action_text} место *{number}*"
+            + make_lot_suffix(lot)
+        )
+        update_state(
+            update,
+            context,
+            lot,
+            action,
+            freed=toggled.state == "free",
+            owners=[user_id],
+        )
+        log_event(update, action, number)
 
 
 def cancel_handler(update: Update, context: CallbackContext) -> None:
@@ -98,24 +152,35 @@ def cancel_handler(update: Update, context: CallbackContext) -> None:
         or not config["whitelist"]
     ):
         manage_user(update, context)
-        number = update.callback_query.data.split(".")[1]
-        parking = context.bot_data["parking"]
+        user_id = str(update.effective_user.id)
         try:
-            for place in parking.places:
-                if place.number == number:
-                    place.cancel_reserve(str(update.effective_user.id))
-            update.callback_query.answer(f"Вы отменили резерв места {number}")
-            action = (
-                f"*{users[str(update.effective_user.id)]}* "
-                + f"отменил резерв места *{number}*"
+            lot, number, version = parse_place_data(
+                update.callback_query.data.split(".", 1)[1]
             )
-            update_state(update, context, action)
-            log_event(update, action)
+            parking = get_parking(context, lot)
+            place, canceled = parking.cancel_reserve(number, user_id, version)
+            share_place(context, lot, canceled, version)
+        except StaleError:
+            update.callback_query.answer("Клавиатура устарела, отправили новую")
+            send_status(update, context, current_lot(context, user_id))
+            log_event(update, "Пытался отменить резерв на старой клавиатуре")
+            return
         except ValueError:
             update.callback_query.answer(
                 "Используйте клавиатуру из последнего сообщения!"
             )
             log_event(update, "Пытался отменить резерв на старой клавиатуре")
+            return
+        count_place(context, lot, place, cancel=True)
+        scheduler.cancel(("reserve", lot, number))
+        update.callback_query.answer(f"Вы отменили резерв места {number}")
+        action = (
+            f"*{users[str(update.effective_user.id)]}* "
+            + f"отменил резерв места *{number}*"
+            + make_lot_suffix(lot)
+        )
+        update_state(update, context, lot, action, freed=True, owners=[user_id])
+        log_event(update, action, number)
 
 
 def clear_handler(update: Update, context: CallbackContext) -> None:
@@ -127,18 +192,16 @@ def clear_handler(update: Update, context: CallbackContext) -> None:
     ):
         manage_user(update, context)
         try:
-            parking = context.bot_data["parking"]
-            places = parking.clear()
-            if places:
-                stats = context.bot_data["stats"]
-                for place in places:
-                    stats.count(place)
+            lot = parse_lot_data(context, update.callback_query.data)
+            places = clear_parking(context, lot)
             update.callback_query.answer("Вы выбрали очистку парковки")
             action = (
                 f"*{users[str(update.effective_user.id)]}* "
                 + "очистил парковочное пространство"
+                + make_lot_suffix(lot)
             )
-            update_state(update, context, action)
+            owners = [place.occupant for place in places]
+            update_state(update, context, lot, action, freed=True, owners=owners)
             log_event(update, action)
         except ValueError:
             update.callback_query.answer(
@@ -147,6 +210,136 @@ def clear_handler(update: Update, context: CallbackContext) -> None:
             log_event(update, "Пытался очистить парковку на старой клавиатуре")
 
 
+def clear_parking(context: CallbackContext, lot: str) -> list:
+    """Frees all places of lot, counts them in statistics.
+
+    Returns:
+        list: places as they were before clear.
+
+    Raises:
+        ValueError: if all places are already free.
+    """
+    if store is None:
+        places = context.bot_data["parking"][lot].clear()
+    else:
+        places = store.clear_places(lot)
+        sync_shared(context)
+        if not places:
+            raise ValueError
+    for place in places:
+        count_place(context, lot, place)
+        scheduler.cancel(("reserve", lot, place.number))
+    return places
+
+
+def schedule_expiry(context: CallbackContext, lot: str, place: PlaceSnapshot) -> None:
+    """Sets timer for reserve of place if reserves have time to live."""
+    if config.get("reserve_ttl"):
+        since = place.occupy_since or datetime.now()
+        scheduler.schedule(
+            ("reserve", lot, place.number),
+            since + timedelta(minutes=config["reserve_ttl"]),
+            context,
+        )
+
+
+def parse_clear_time(value: str) -> tuple:
+    """Parses "HH:MM" time of nightly clear.
+
+    Returns:
+        tuple: hour and minute.
+
+    Raises:
+        ValueError: if time is not "HH:MM".
+    """
+    try:
+        hour, minute = map(int, value.split(":"))
+    except (AttributeError, ValueError):
+        hour = minute = -1
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f'Auto clear time "{value}" should be "HH:MM"')
+    return hour, minute
+
+
+def schedule_clear(context: CallbackContext, after: datetime = None) -> None:
+    """Sets timer for next nightly clear of all lots, if it's on.
+
+    Args:
+        context: passed to timer.
+        after (optional): time to find next clear after, now if omitted.
+    """
+    if config.get("auto_clear"):
+        hour, minute = parse_clear_time(config["auto_clear"])
+        after = after or datetime.now()
+        when = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if when <= after:
+            when += timedelta(days=1)
+        scheduler.schedule("clear", when, context)
+
+
+def run_timers(due: list) -> None:
+    """Expires reserves and clears lots by scheduler timers.
+
+    Changes are broadcast once per lot for all timers due together.
+
+    Args:
+        due: list of timer keys and contexts.
+    """
+    events = {}
+    context = due[0][1]
+    sync_shared(context)
+    for key, _ in due:
+        if key == "clear":
+            # Timer can be taken early within window, so it's not rescheduled
+            # for the same time
+            schedule_clear(
+                context, datetime.now() + timedelta(seconds=scheduler.window)
+            )
+            for lot in list(context.bot_data["parking"]):
+                try:
+                    places = clear_parking(context, lot)
+                except ValueError:
+                    continue
+                events.setdefault(lot, []).append(
+                    (
+                        "Парковка очищена автоматически" + make_lot_suffix(lot),
+                        True,
+                        [place.occupant for place in places],
+                        None,
+                    )
+                )
+            continue
+        _, lot, number = key
+        try:
+            place = get_parking(context, lot).place(number)
+            # Version is taken first, so reserve is canceled only as it's seen
+            version = place.version
+            occupant = place.occupant
+            old, canceled = context.bot_data["parking"][lot].cancel_reserve(
+                number, occupant, version
+            )
+            share_place(context, lot, canceled, version)
+        except ValueError:
+            continue
+        count_place(context, lot, old, cancel=True)
+        events.setdefault(lot, []).append(
+            (
+                f"Истек резерв места *{number}* "
+                + f"пользователя *{users.get(occupant, occupant)}*"
+                + make_lot_suffix(lot),
+                True,
+                [occupant],
+                None,
+            )
+        )
+    for lot, lot_events in events.items():
+        notify_lot(None, context, lot, lot_events)
+        for info, *_ in lot_events:
+            logger.log(INFO, info.replace("*", ""))
+    if events:
+        context.dispatcher.update_persistence()
+
+
 def statistics_handler(update: Update, context: CallbackContext) -> None:
     """Handler for statistic button."""
     if (
@@ -155,84 +348,1148 @@ def statistics_handler(update: Update, context: CallbackContext) -> None:
         or not config["whitelist"]
     ):
         manage_user(update, context)
+        try:
+            lot = parse_lot_data(context, update.callback_query.data)
+        except StaleError:
+            update.callback_query.answer(
+                "Используйте клавиатуру из последнего сообщения!"
+            )
+            log_event(update, "Запросил статистику на старой клавиатуре")
+            return
         update.callback_query.answer("Вы запросили статистику")
-        stats = context.bot_data["stats"]
-        update_state(update, context, stats.message_text, True)
+        stats = context.bot_data["stats"][lot]
+        with metrics.timer("stats_message_text"):
+            published = get_published_stats(lot)
+            text = published[1] if published else stats.message_text
+        update_state(update, context, lot, text, True)
+        if (
+            stats.log is not None
+            and charts_config.get("days", 84)
+            and charts_available()
+        ):
+            charts = render_lot_charts(context, lot)
+            if charts[1] is not None:
+                user_id = str(update.effective_user.id)
+                broadcaster.submit(
+                    user_id, make_charts_notification(update, lot, charts)
+                )
         log_event(update, "Запросил статистику")
 
 
+def period_statistics_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for statistics for last days command."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        lot = current_lot(context, str(update.effective_user.id))
+        stats = context.bot_data["stats"][lot]
+        if stats.log is None:
+            update.effective_message.reply_text("История событий не ведется")
+            return
+        try:
+            days = int(context.args[0]) if context.args else 30
+            if days < 1:
+                raise ValueError
+            since = date.today() - timedelta(days=days - 1)
+        except (ValueError, OverflowError):
+            update.effective_message.reply_text("Укажите количество дней числом")
+            log_event(update, "Отправил stats с неверным аргументом")
+            return
+        update_state(update, context, lot, stats.period_text(since), True)
+        log_event(update, f"Запросил статистику за {days} дней")
+
+
 def update_state(
-    update: Update, context: CallbackContext, info: str, personal=False
+    update: Update,
+    context: CallbackContext,
+    lot: str,
+    info: str,
+    personal=False,
+    freed=False,
+    owners=(),
 ) -> None:
-    """Sends personal or bulk messages to users.
+    """Enqueues personal or bulk messages to users for broadcaster.
+
+    Bulk messages are sent to subscribers of lot by their notification
+    mode, see `make_infos`.
 
     Args:
-        update: for identifying users and getting bot for bulk send.
+        update: for identifying users, None for changes made by timers.
         context: for getting bot and user data.
+        lot: parking lot, bulk messages are sent to its subscribers.
         info: info string for info message.
         personal (optional): should this message be personal only.
         Defaults to False.
+        freed (optional): has change freed some places.
+        owners (optional): users whose places are changed.
     """
-    parking = context.bot_data["parking"]
     if personal:
-        message_receivers = [str(update.effective_user.id)]
+        user = str(update.effective_user.id)
+        broadcast_state(update, context, lot, {user: info}, True)
     else:
-        message_receivers = users
+        actor = str(update.effective_user.id) if update else None
+        notify_lot(update, context, lot, [(info, freed, owners, actor)])
 
-    for user in message_receivers:
-        markup = make_keyboard(context, user)
-        try:
-            update.effective_message.bot.send_message(
-                text=info, chat_id=user, parse_mode="MarkdownV2"
+
+def notify_lot(
+    update: Update, context: CallbackContext, lot: str, events: list
+) -> None:
+    """Enqueues bulk messages about events of lot.
+
+    With coalescing window events are collected by lot and sent later as
+    one digest with the final status.
+
+    Args:
+        update: for identifying users, None for changes made by timers.
+        context: for getting bot and user data.
+        lot: parking lot.
+        events: list of info, freed, owners and actor tuples, actor is
+        user making change or None for timers, see `update_state`.
+    """
+    if store is not None:
+        # Leader process sends notifications of all processes
+        for info, freed, owners, actor in events:
+            store.post(lot, "event", [info, freed, list(owners), actor])
+    else:
+        deliver_events(update, context, lot, events)
+
+
+def deliver_events(
+    update: Update, context: CallbackContext, lot: str, events: list
+) -> None:
+    """Enqueues bulk messages about events of lot, see `notify_lot`."""
+    if coalescer.enabled:
+        for event in events:
+            coalescer.add(lot, (update, context, event))
+    else:
+        broadcast_state(update, context, lot, make_infos(context, lot, events))
+
+
+def flush_digest(lot: str, batch: list) -> None:
+    """Broadcasts events collected by coalescer as one digest."""
+    update, context, _ = batch[-1]
+    metrics.inc("coalesced", len(batch) - 1)
+    events = [event for _, _, event in batch]
+    broadcast_state(update, context, lot, make_infos(context, lot, events))
+
+
+def make_infos(context: CallbackContext, lot: str, events: list) -> dict:
+    """Info texts of events by subscribers of lot who want them.
+
+    Subscribers are indexed by notification mode, so only users getting
+    events are visited: "all" get every event, "free" get events freeing
+    places, "mine" get events of their places and "off" get nothing.
+    User making change gets its event in any mode, so the keyboard of
+    their next press is up to date.
+
+    Args:
+        context: for getting subscribers.
+        lot: parking lot.
+        events: list of info, freed, owners and actor tuples, actor is
+        user making change or None for timers, see `update_state`.
+
+    Returns:
+        dict: info text by user id.
+    """
+    modes = context.bot_data["subscribers"].get(lot, {})
+    infos = dict.fromkeys(modes.get("all", ()), "\n".join(event[0] for event in events))
+    freed = [info for info, is_freed, *_ in events if is_freed]
+    if freed:
+        infos.update(dict.fromkeys(modes.get("free", ()), "\n".join(freed)))
+    lines = {}
+    for info, _, owners, actor in events:
+        readers = modes.get("mine", set()).intersection(owners)
+        if actor is not None and actor not in infos:
+            readers.add(actor)
+        for user in readers:
+            lines.setdefault(user, []).append(info)
+    infos.update((user, "\n".join(user_lines)) for user, user_lines in lines.items())
+    return {
+        user: info
+        for user, info in infos.items()
+        if user in users and user not in blocked
+    }
+
+
+def broadcast_state(
+    update: Update, context: CallbackContext, lot: str, infos: dict, personal=False
+) -> None:
+    """Enqueues messages with info and current status.
+
+    Args:
+        update: for identifying users, None for changes made by timers.
+        context: for getting bot and user data.
+        lot: parking lot.
+        infos: info text by user id.
+        personal (optional): is this message personal.
+    """
+    with metrics.timer("update_state"):
+        parking = context.bot_data["parking"][lot]
+        state_text = make_status_text(lot, parking)
+        for user, info in infos.items():
+            with metrics.timer("make_keyboard"):
+                markup = make_keyboard(context, lot, user)
+            broadcaster.submit(
+                user,
+                make_notification(
+                    update, context, user, info, state_text, markup, personal
+                ),
             )
-            update.effective_message.bot.send_message(
-                text=parking.state_text, chat_id=user, reply_markup=markup
+        metrics.inc("notifications", len(infos))
+
+
+def make_notification(
+    update: Update,
+    context: CallbackContext,
+    user: str,
+    info: str,
+    state_text: str,
+    markup: InlineKeyboardMarkup,
+    personal: bool,
+) -> Callable:
+    """Makes broadcast job sending info and status messages to user.
+
+    In edit mode bulk info is merged into the status message, which is
+    edited in place instead of sending new messages, and personal info
+    is sent alone.
+    """
+
+    def job() -> None:
+        bot = broadcaster.bot
+        if edit_mode() and not personal:
+            text = "\n\n".join([info, escape_markdown(state_text, version=2)])
+            update_status(context, user, text, markup, "MarkdownV2")
+        else:
+            broadcaster.call(
+                user, bot.send_message, text=info, chat_id=user, parse_mode="MarkdownV2"
             )
-            log_event(update, f"Отправили уведомление {users[user]}")
-        except Unauthorized:
-            log_event(update, f"Пользователь {users[user]} заблокировал бота")
+            # In edit mode status message is already up to date
+            if not edit_mode():
+                broadcaster.call(
+                    user,
+                    bot.send_message,
+                    text=state_text,
+                    chat_id=user,
+                    reply_markup=markup,
+                )
+        log_event(update, f"Отправили уведомление {users.get(user, user)}")
+
+    return job
+
+
+def render_lot_charts(context: CallbackContext, lot: str) -> tuple:
+    """Renders statistics charts of lot, if they are rendered for older version.
+
+    Charts are rendered once per statistics version by handler thread,
+    so broadcast threads only send them.
+
+    Returns:
+        tuple: statistics version, charts image (None if there is nothing
+        to draw) and its file id (None if it was not sent yet).
+    """
+    stats = context.bot_data["stats"][lot]
+    with chart_lock:
+        published = get_published_stats(lot)
+        version = published[0] if published else stats.version
+        cached = chart_cache.get(lot)
+        if cached is None or cached[0] != version:
+            until = datetime.now()
+            with metrics.timer("render_charts"):
+                image = render_charts(
+                    stats.log,
+                    len(context.bot_data["parking"][lot].places),
+                    until - timedelta(days=charts_config.get("days", 84)),
+                    until,
+                    charts_config.get("places", 10),
+                )
+            cached = chart_cache[lot] = (version, image, None)
+    return cached
+
+
+def make_charts_notification(update: Update, lot: str, charts: tuple) -> Callable:
+    """Makes broadcast job sending rendered charts of lot to user.
+
+    After first sending the same photo is sent by its file id.
+
+    Args:
+        charts: made by `render_lot_charts`.
+    """
+    user = str(update.effective_user.id)
+
+    def job() -> None:
+        version, image, file_id = charts
+        message = broadcaster.call(
+            user, broadcaster.bot.send_photo, chat_id=user, photo=file_id or image
+        )
+        if file_id is None and chart_cache.get(lot) is charts:
+            chart_cache[lot] = (version, image, message.photo[-1].file_id)
+        log_event(update, f"Отправили графики {users.get(user, user)}")
+
+    return job
+
+
+def edit_mode() -> bool:
+    """Is status message edited in place.
 
+    Edit mode is off in shared mode, as last status message of user is
+    known only to process which sent it, so status is always sent anew.
+    """
+    return bool(config.get("edit_messages")) and store is None
+
+
+def update_status(
+    context: CallbackContext,
+    user: str,
+    text: str,
+    markup: InlineKeyboardMarkup,
+    parse_mode: str = None,
+) -> None:
+    """Edits last status message of user or sends new one if edit fails.
+
+    Nothing is sent if text and keyboard are the same as last time.
+    """
+    bot = broadcaster.bot
+    last = context.bot_data["messages"].get(user)
+    text_digest, markup_digest = make_digest(text, markup)
+    if last is not None:
+        if last["text"] == text_digest and last["markup"] == markup_digest:
+            return
+        try:
+            if last["text"] == text_digest:
+                broadcaster.call(
+                    user,
+                    bot.edit_message_reply_markup,
+                    chat_id=user,
+                    message_id=last["id"],
+                    reply_markup=markup,
+                )
+            else:
+                broadcaster.call(
+                    user,
+                    bot.edit_message_text,
+                    text=text,
+                    chat_id=user,
+                    message_id=last["id"],
+                    reply_markup=markup,
+                    parse_mode=parse_mode,
+                )
+            remember_status(context, user, last["id"], text, markup)
+            return
+        except BadRequest as error:
+            if "not modified" in error.message:
+                remember_status(context, user, last["id"], text, markup)
+                return
+    message = broadcaster.call(
+        user,
+        bot.send_message,
+        text=text,
+        chat_id=user,
+        reply_markup=markup,
+        parse_mode=parse_mode,
+    )
+    remember_status(context, user, message.message_id, text, markup)
+
+
+def send_status(update: Update, context: CallbackContext, lot: str) -> None:
+    """Sends new status message of lot to user."""
+    user_id = str(update.effective_user.id)
+    parking = context.bot_data["parking"][lot]
+    text = make_status_text(lot, parking)
+    markup = make_keyboard(context, lot, user_id)
+    message = update.effective_message.reply_text(text, reply_markup=markup)
+    remember_status(context, user_id, message.message_id, text, markup)
+
+
+def make_status_text(lot: str, parking: Parking) -> str:
+    """Status message text, with name of lot if lots are named.
+
+    Big lots are summarised as numbers of places in each state.
+    """
+    text = parking.state_summary if is_big(parking) else parking.state_text
+    if lot:
+        return f"{lot}: {text}"
+    return text
+
+
+def make_lot_suffix(lot: str) -> str:
+    """Name of named lot for MarkdownV2 info messages."""
+    if lot:
+        return f" на парковке *{escape_markdown(lot, version=2)}*"
+    return ""
+
+
+def remember_status(
+    context: CallbackContext,
+    user: str,
+    message_id: int,
+    text: str,
+    markup: InlineKeyboardMarkup,
+) -> None:
+    """Stores user's last status message id and content digest."""
+    text_digest, markup_digest = make_digest(text, markup)
+    context.bot_data["messages"][user] = {
+        "id": message_id,
+        "text": text_digest,
+        "markup": markup_digest,
+    }
 
-def make_keyboard(context: CallbackContext, user_id: str) -> InlineKeyboardMarkup:
-    """Making of personalized keyboards."""
+
+def make_digest(text: str, markup: InlineKeyboardMarkup) -> tuple:
+    """Stable digests of status message text and keyboard."""
+    return (
+        crc32(text.encode()),
+        crc32(dumps(markup.to_dict(), sort_keys=True).encode()),
+    )
+
+
+def drop_user(user_id: str) -> None:
+    """Removes user that blocked the bot from future broadcasts.
+
+    User is kept in users (they are whitelist too), so user can come
+    back by /start after unblocking the bot.
+    """
+    if user_id in users and user_id not in blocked:
+        blocked.add(user_id)
+        if store is not None:
+            store.set_blocked(user_id, True)
+        logger.log(INFO, f"Пользователь {users[user_id]} заблокировал бота")
+
+
+def unblock_user(user_id: str) -> None:
+    """Returns user to broadcasts after /start, see `drop_user`."""
+    if user_id in blocked:
+        blocked.discard(user_id)
+        if store is not None:
+            store.set_blocked(user_id, False)
+
+
+def make_keyboard(
+    context: CallbackContext, lot: str, user_id: str
+) -> InlineKeyboardMarkup:
+    """Making of personalized keyboards.
+
+    Keyboard is the same for all users of lot except cancel buttons of
+    the user's reserves, so shared part is built once per parking
+    version. Lots bigger than page size get paged grid keyboard.
+    """
+    parking = context.bot_data["parking"][lot]
+    paged = is_big(parking)
+    skeleton = keyboard_cache.get(lot)
+    if skeleton is None or skeleton[:2] != (parking, parking.version):
+        if paged:
+            skeleton = make_grid_skeleton(lot, parking)
+        else:
+            skeleton = make_keyboard_skeleton(lot, parking)
+        keyboard_cache[lot] = skeleton
+    if paged:
+        return make_keyboard_page(skeleton, lot, user_id)
+    _, _, keyboard, markup, reserves = skeleton
+    if user_id not in reserves:
+        return markup
+    keyboard = list(keyboard)
+    for row, data in reserves[user_id]:
+        cancel_button = InlineKeyboardButton(
+            CANCEL_CAPTION, callback_data="".join(["cancel.", data])
+        )
+        keyboard[row] = [keyboard[row][0], cancel_button]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def make_keyboard_skeleton(lot: str, parking: Parking) -> tuple:
+    """Shared keyboard of parking lot.
+
+    Returns:
+        tuple: parking, its version, keyboard rows, markup and dict of
+        user's reserves as lists of (row, place callback data).
+    """
+    # Version is taken first, so skeleton is never older than its version
+    version = parking.version
     keyboard = []
-    parking = context.bot_data["parking"]
+    reserves = {}
     for place in parking.state:
-        place_sign, state, number, occupant = place
+        place_sign, state, number, occupant, place_version = place
         if occupant is not None:
-            person = users[str(occupant)]
+            person = users.get(str(occupant), "")
         else:
             person = "место свободно"
         caption = " ".join([place_sign, number, person])
-        place_button = InlineKeyboardButton(caption, callback_data=number)
-        cancel_button = InlineKeyboardButton(
-            " ".join([emojize(":right_arrow_curving_left:"), "Отменить резерв"]),
-            callback_data="".join(["cancel.", number]),
+        data = make_place_data(lot, number, place_version)
+        keyboard.append([InlineKeyboardButton(caption, callback_data=data)])
+        if state == "reserved":
+            reserves.setdefault(occupant, []).append((len(keyboard) - 1, data))
+    keyboard += make_control_rows(lot, parking)
+    markup = InlineKeyboardMarkup(keyboard)
+    return parking, version, keyboard, markup, reserves
+
+
+def make_grid_skeleton(lot: str, parking: Parking) -> tuple:
+    """Shared parts of paged grid keyboard of big parking lot.
+
+    Returns:
+        tuple: parking, its version, place buttons, control rows, indexes
+        of free places, dicts of indexes of user's places and of user's
+        reserves as (index, place callback data) and cache of shared pages.
+    """
+    # Version is taken first, so skeleton is never older than its version
+    version = parking.version
+    buttons = []
+    free = []
+    owned = {}
+    reserves = {}
+    for index, place in enumerate(parking.state):
+        place_sign, state, number, occupant, place_version = place
+        data = make_place_data(lot, number, place_version)
+        caption = " ".join([place_sign, number])
+        buttons.append(InlineKeyboardButton(caption, callback_data=data))
+        if occupant is None:
+            free.append(index)
+        else:
+            owned.setdefault(occupant, []).append(index)
+        if state == "reserved":
+            reserves.setdefault(occupant, []).append((index, data))
+    controls = make_control_rows(lot, parking)
+    return parking, version, buttons, controls, free, owned, reserves, {}
+
+
+def make_keyboard_page(skeleton: tuple, lot: str, user_id: str) -> InlineKeyboardMarkup:
+    """Page of grid keyboard in user's view, see `make_grid_skeleton`.
+
+    Only places of current page of filter are rendered. Pages without
+    user's places are the same for all users, so they are cached.
+    """
+    _, _, buttons, controls, free, owned, reserves, pages = skeleton
+    view_lot, view, page = keyboard_views.get(user_id, (lot, "all", 0))
+    if view_lot != lot:
+        view, page = "all", 0
+    if view == "free":
+        indexes = free
+    elif view == "mine":
+        indexes = owned.get(user_id, [])
+    else:
+        indexes = range(len(buttons))
+    size = keyboard_config.get("page_size", 40)
+    count = max(1, ceil(len(indexes) / size))
+    page = min(page, count - 1)
+    shown = indexes[page * size : (page + 1) * size]
+    cancels = [data for index, data in reserves.get(user_id, ()) if index in shown]
+    shared = view != "mine" and not cancels
+    if shared and (view, page) in pages:
+        return pages[(view, page)]
+    cancel_buttons = [
+        InlineKeyboardButton(
+            " ".join([CANCEL_SIGN, parse_place_data(data)[1]]),
+            callback_data="".join(["cancel.", data]),
         )
-        clear_button = InlineKeyboardButton(
-            " ".join([emojize(":FREE_button:"), "Очистить парковку"]),
-            callback_data="clear",
+        for data in cancels
+    ]
+    keyboard = make_grid([buttons[index] for index in shown])
+    keyboard += make_grid(cancel_buttons)
+    keyboard += make_page_rows(lot, view, page, count)
+    keyboard += controls
+    markup = InlineKeyboardMarkup(keyboard)
+    if shared:
+        pages[(view, page)] = markup
+    return markup
+
+
+def make_grid(buttons: list) -> list:
+    """Rows of buttons by number of columns from config."""
+    columns = keyboard_config.get("columns", 4)
+    return [buttons[x : x + columns] for x in range(0, len(buttons), columns)]
+
+
+def make_page_rows(lot: str, view: str, page: int, count: int) -> list:
+    """Filter and page navigation rows of grid keyboard."""
+    filters = []
+    for name, caption in VIEW_CAPTIONS.items():
+        if name == view:
+            caption = " ".join(["•", caption])
+        filters.append(
+            InlineKeyboardButton(caption, callback_data=make_page_data(lot, name, 0))
         )
-        statistics_button = InlineKeyboardButton(
-            " ".join([emojize(":bar_chart:"), "Статистика"]), callback_data="statistics"
+    rows = [filters]
+    if count > 1:
+        rows.append(
+            [
+                InlineKeyboardButton(
+                    "◀", callback_data=make_page_data(lot, view, (page - 1) % count)
+                ),
+                InlineKeyboardButton(
+                    f"{page + 1}/{count}", callback_data=make_page_data(lot, view, page)
+                ),
+                InlineKeyboardButton(
+                    "▶", callback_data=make_page_data(lot, view, (page + 1) % count)
+                ),
+            ]
         )
-        if state == "reserved" and occupant == user_id:
-            keyrow = []
-            keyrow.append(place_button)
-            keyrow.append(cancel_button)
-            keyboard.append(keyrow)
-        else:
-            keyboard.append([place_button])
+    return rows
+
+
+def make_control_rows(lot: str, parking: Parking) -> list:
+    """Clear, statistics and lots buttons rows."""
+    rows = []
+    statistics_button = InlineKeyboardButton(
+        STATISTICS_CAPTION, callback_data=f"statistics.{lot}"
+    )
     if not parking.is_free:
-        keyrow = []
-        keyrow.append(clear_button)
-        keyrow.append(statistics_button)
-        keyboard.append(keyrow)
+        clear_button = InlineKeyboardButton(CLEAR_CAPTION, callback_data=f"clear.{lot}")
+        rows.append([clear_button, statistics_button])
     else:
-        keyboard.append([statistics_button])
+        rows.append([statistics_button])
+    if len(get_lots()) > 1:
+        rows.append([InlineKeyboardButton(LOTS_CAPTION, callback_data="lots")])
+    return rows
+
+
+def is_big(parking: Parking) -> bool:
+    """Is lot too big for keyboard with all places."""
+    return len(parking.places) > keyboard_config.get("page_size", 40)
+
+
+def make_lots_keyboard(context: CallbackContext) -> InlineKeyboardMarkup:
+    """Keyboard for choosing parking lot."""
+    keyboard = []
+    for lot in get_lots():
+        parking = context.bot_data["parking"][lot]
+        caption = make_status_text(lot, parking)
+        keyboard.append([InlineKeyboardButton(caption, callback_data=f"lot.{lot}")])
     return InlineKeyboardMarkup(keyboard)
 
 
+def make_place_data(lot: str, number: str, version: int) -> str:
+    """Callback data of place button, with lot and place version for
+    rejecting presses on stale keyboards."""
+    return f"{lot}/{number}@{version}"
+
+
+def parse_place_data(data: str) -> tuple:
+    """Lot, place number and version from callback data.
+
+    Raises:
+        StaleError: if data has no lot or version (keyboard of older bot).
+    """
+    lot, separator, data = data.partition("/")
+    number, _, version = data.rpartition("@")
+    if not separator or not number or not version.isdigit():
+        raise StaleError
+    return lot, number, int(version)
+
+
+def make_page_data(lot: str, view: str, page: int) -> str:
+    """Callback data of filter and page buttons of grid keyboard."""
+    return f"page.{lot}/{view}/{page}"
+
+
+def parse_page_data(context: CallbackContext, data: str) -> tuple:
+    """Lot, filter and page number from callback data.
+
+    Raises:
+        StaleError: if there is no such lot or filter.
+    """
+    lot, _, view = data.partition(".")[2].partition("/")
+    view, _, page = view.partition("/")
+    if (
+        lot not in context.bot_data["parking"]
+        or view not in VIEW_CAPTIONS
+        or not page.isdigit()
+    ):
+        raise StaleError
+    return lot, view, int(page)
+
+
+def parse_lot_data(context: CallbackContext, data: str) -> str:
+    """Lot from callback data of control button ("clear.lot").
+
+    Raises:
+        StaleError: if data has no lot or there is no such lot.
+    """
+    _, separator, lot = data.partition(".")
+    if not separator or lot not in context.bot_data["parking"]:
+        raise StaleError
+    return lot
+
+
+def get_parking(context: CallbackContext, lot: str) -> Parking:
+    """Parking of lot.
+
+    Raises:
+        StaleError: if there is no such lot.
+    """
+    try:
+        return context.bot_data["parking"][lot]
+    except KeyError:
+        raise StaleError
+
+
+def get_lots(options: dict = None) -> dict:
+    """Places by lot name, config without lots is single lot with empty name.
+
+    Args:
+        options (optional): config to take lots from, current one if omitted.
+    """
+    options = config if options is None else options
+    return options.get("lots") or {"": options["places"]}
+
+
+def check_config(options: dict) -> None:
+    """Checks lots and options, which can't be used as they are.
+
+    Raises:
+        ValueError: with description of wrong option.
+    """
+    check_lots(get_lots(options), options.get("events_file"))
+    if options.get("auto_clear"):
+        parse_clear_time(options["auto_clear"])
+
+
+def check_lots(lots: dict, events_file: str = None) -> None:
+    """Checks lots can be used in callback data and event log names.
+
+    Raises:
+        ValueError: with description of wrong lot or place.
+    """
+    if events_file and len(lots) > 1 and "{lot}" not in events_file:
+        raise ValueError('Events file name should contain "{lot}" for several lots')
+    for lot, places in lots.items():
+        if "/" in lot:
+            raise ValueError(f'Lot name "{lot}" should not contain "/"')
+        for number in places:
+            # Callback data is limited to 64 bytes
+            if len(make_place_data(lot, f"cancel.{number}", 10**12).encode()) > 64:
+                raise ValueError(f'Place number "{number}" is too long')
+
+
+def reconcile_lots(context: CallbackContext) -> dict:
+    """Makes parkings, statistics and subscribers match lots in config.
+
+    Places still in config keep their state, removed places are counted
+    in statistics as freed (or canceled reserves) and new places are free.
+    In shared mode places are taken from shared store first and written
+    back, if they are changed.
+
+    Returns:
+        dict: lists of added place numbers and removed place snapshots by
+        changed lot.
+    """
+    parkings = context.bot_data["parking"]
+    subscribers = context.bot_data["subscribers"]
+    events_file = config.get("events_file")
+    changes = {}
+    lots = get_lots()
+    for lot, places in lots.items():
+        stats = context.bot_data["stats"].setdefault(lot, Stats(users))
+        subscribers.setdefault(lot, {})
+        if events_file and stats.log is None:
+            stats.attach(EventLog(events_file.format(lot=lot)))
+        if lot not in parkings:
+            parkings[lot] = Parking(places)
+    sync_shared(context)
+    for lot, places in lots.items():
+        numbers = [place.number for place in parkings[lot].places]
+        if numbers == [str(number) for number in places]:
+            continue
+        retired = parkings[lot].reconcile(places)
+        for place in retired:
+            scheduler.cancel(("reserve", lot, place.number))
+            if place.state == "reserved":
+                count_place(context, lot, place, cancel=True)
+            elif place.state == "occupied":
+                count_place(context, lot, place)
+        added = [number for number in places if str(number) not in numbers]
+        changes[lot] = (added, retired)
+    for lot in parkings.keys() - lots.keys():
+        for place in parkings.pop(lot).places:
+            scheduler.cancel(("reserve", lot, place.number))
+        subscribers.pop(lot, None)
+    if store is not None:
+        for lot, parking in parkings.items():
+            if lot in changes or f"lot:{lot}" not in shared_versions:
+                store.save_places(
+                    lot,
+                    [place.as_tuple + (place.version,) for place in parking.places],
+                )
+    return changes
+
+
+def user_lot(context: CallbackContext, user_id: str) -> str:
+    """Lot user is subscribed to, None if user hasn't chosen it."""
+    for lot, modes in context.bot_data["subscribers"].items():
+        if any(user_id in subscribers for subscribers in modes.values()):
+            return lot
+    return None
+
+
+def user_mode(context: CallbackContext, user_id: str) -> str:
+    """Notification mode of user, "all" if user isn't subscribed."""
+    for modes in context.bot_data["subscribers"].values():
+        for mode, subscribers in modes.items():
+            if user_id in subscribers:
+                return mode
+    return "all"
+
+
+def current_lot(context: CallbackContext, user_id: str) -> str:
+    """Lot user is subscribed to or first lot."""
+    return user_lot(context, user_id) or next(iter(get_lots()))
+
+
+def subscribe(
+    context: CallbackContext, user_id: str, lot: str, mode: str = None
+) -> None:
+    """Subscribes user to lot changes instead of other lot.
+
+    Args:
+        context: for getting subscribers.
+        user_id: user to subscribe.
+        lot: parking lot.
+        mode (optional): one of NOTIFY_MODES, current mode of user if
+        omitted.
+    """
+    mode = mode or user_mode(context, user_id)
+    unsubscribe(context, user_id, False)
+    modes = context.bot_data["subscribers"].setdefault(lot, {})
+    modes.setdefault(mode, set()).add(user_id)
+    if store is not None:
+        store.set_subscriber(user_id, lot, mode)
+
+
+def unsubscribe(context: CallbackContext, user_id: str, share=True) -> None:
+    for modes in context.bot_data["subscribers"].values():
+        for subscribers in modes.values():
+            subscribers.discard(user_id)
+    if store is not None and share:
+        store.set_subscriber(user_id)
+
+
+def count_place(
+    context: CallbackContext,
+    lot: str,
+    place: PlaceSnapshot,
+    cancel=False,
+    user: str = None,
+) -> None:
+    """Counts changed place in statistics of lot, see `Stats.count`.
+
+    In shared mode place is counted by leader process from outbox.
+
+    Args:
+        context: for getting statistics.
+        lot: parking lot.
+        place: place before change.
+        cancel (optional): is it reserve cancel, see `Stats.cancel`.
+        user (optional): user changing place, logged for reserves.
+    """
+    if store is not None:
+        since = place.occupy_since.timestamp() if place.occupy_since else None
+        store.post(
+            lot,
+            "cancel" if cancel else "count",
+            [place.number, place.state, place.occupant, since, user],
+        )
+    elif cancel:
+        context.bot_data["stats"][lot].cancel(place)
+    else:
+        context.bot_data["stats"][lot].count(place, user)
+
+
+def save_user(user_id: str) -> None:
+    """Writes added, renamed or removed user to users file and shared store."""
+    users_writer.schedule(users)
+    if store is not None:
+        store.set_user(user_id, users.get(user_id))
+
+
+def share_place(
+    context: CallbackContext, lot: str, place: PlaceSnapshot, version: int
+) -> None:
+    """Writes place changed from version to shared store.
+
+    Version of lot is taken as synced, if sync made meanwhile hasn't
+    put place back as it was before change, so own writes aren't reread.
+
+    Args:
+        context: for getting parking.
+        lot: parking lot.
+        place: place after change.
+        version: place version before change.
+
+    Raises:
+        StaleError: if other process changed place, parking is synced then.
+    """
+    if store is None:
+        return
+    shared = store.update_place(lot, place, version)
+    if shared is None:
+        sync_shared(context)
+        raise StaleError
+    key = f"lot:{lot}"
+    with shared_lock:
+        current = context.bot_data["parking"][lot].place(place.number)
+        if current.version == version + 1 and shared_versions.get(key) == shared - 1:
+            shared_versions[key] = shared
+
+
+def sync_shared(context: CallbackContext) -> None:
+    """Takes users, subscribers and places changed by other processes.
+
+    Only data with version changed since last sync is read, so it's
+    cheap enough to call before every update.
+    """
+    if store is None:
+        return
+    with shared_lock:
+        for key, version in store.versions().items():
+            if shared_versions.get(key) == version:
+                continue
+            if key == "users":
+                refresh_users(context, store.users())
+                shared = store.blocked()
+                blocked.update(shared)
+                blocked.difference_update(
+                    [user for user in list(blocked) if user not in shared]
+                )
+            elif key == "subscribers":
+                shared = store.subscribers()
+                subscribers = context.bot_data["subscribers"]
+                for lot in list(subscribers):
+                    subscribers[lot] = shared.get(lot, {})
+            elif key.startswith("lot:"):
+                parking = context.bot_data["parking"].get(key[4:])
+                if parking is None:
+                    # Lot is not configured in this process yet
+                    continue
+                parking.restore(store.places(key[4:]))
+            shared_versions[key] = version
+
+
+def refresh_users(context: CallbackContext, new_users: dict) -> None:
+    """Replaces users by reread ones, with their names in statistics.
+
+    Args:
+        context: for getting statistics.
+        new_users: all users with names.
+    """
+    replace_items(users, new_users)
+    for stats in context.bot_data["stats"].values():
+        stats.update_users(new_users)
+    # Names in keyboard captions changed
+    keyboard_cache.clear()
+
+
+def share_bot_data(context: CallbackContext) -> None:
+    """Writes users and subscribers to shared store started first time."""
+    if not store.users():
+        for user, name in list(users.items()):
+            store.set_user(user, name)
+    if not store.subscribers():
+        for lot, modes in context.bot_data["subscribers"].items():
+            for mode, subscribers in modes.items():
+                for user in list(subscribers):
+                    store.set_subscriber(user, lot, mode)
+
+
+def run_shared(context: CallbackContext) -> None:
+    """Leader election and outbox delivery loop of shared mode.
+
+    Process holding leader lease counts statistics and sends
+    notifications of changes made by all processes.
+    """
+    shared_config = config.get("shared", {})
+    while not shared_stop.wait(shared_config.get("poll_interval", 0.5)):
+        try:
+            elected = store.acquire_lease("leader", shared_config.get("lease_ttl", 10))
+            if elected and not leadership.is_set():
+                logger.log(INFO, f"Процесс {store.owner} стал ведущим")
+                load_shared_stats(context)
+                leadership.set()
+            elif not elected and leadership.is_set():
+                logger.log(INFO, f"Процесс {store.owner} больше не ведущий")
+                leadership.clear()
+            if elected:
+                deliver_outbox(context)
+        except Exception:
+            logger.exception("Ошибка общего режима")
+    if leadership.is_set():
+        store.release_lease("leader")
+        leadership.clear()
+
+
+def load_shared_stats(context: CallbackContext) -> None:
+    """Takes statistics counted by previous leader and publishes them."""
+    persistence = context.dispatcher.persistence
+    loaded = persistence.load_stats()
+    context.bot_data["outbox_applied"] = persistence.load_data("outbox_applied") or 0
+    for lot, stats in context.bot_data["stats"].items():
+        if lot in loaded:
+            stats.as_dict = loaded[lot]
+        store.publish(f"stats:{lot}", stats.version, stats.message_text)
+
+
+def deliver_outbox(context: CallbackContext) -> None:
+    """Counts statistics and sends notifications of changes in outbox.
+
+    Id of last applied change is written with statistics in one
+    transaction before notifications are sent, so changes taken again
+    (after failed write or by next leader) are counted and sent once.
+    """
+    changes = store.take(context.bot_data.get("outbox_applied", 0))
+    if not changes:
+        return
+    sync_shared(context)
+    events = {}
+    counted = set()
+    for _, lot, kind, payload in changes:
+        stats = context.bot_data["stats"].get(lot)
+        if stats is None:
+            # Lot is removed from config
+            continue
+        if kind == "event":
+            events.setdefault(lot, []).append(tuple(payload))
+            continue
+        number, state, occupant, since, user = payload
+        place = PlaceSnapshot(
+            number, state, occupant, datetime.fromtimestamp(since) if since else None
+        )
+        if kind == "cancel":
+            stats.cancel(place)
+        else:
+            stats.count(place, user)
+        counted.add(lot)
+    context.bot_data["outbox_applied"] = changes[-1][0]
+    # Unlike dispatcher, persistence raises errors of write
+    context.dispatcher.persistence.update_bot_data(context.bot_data)
+    for lot, lot_events in events.items():
+        deliver_events(None, context, lot, lot_events)
+    for lot in counted:
+        stats = context.bot_data["stats"][lot]
+        store.publish(f"stats:{lot}", stats.version, stats.message_text)
+    store.ack(changes[-1][0])
+
+
+def get_published_stats(lot: str) -> tuple:
+    """Version and text of statistics published by leader in shared mode,
+    None for single process."""
+    if store is None:
+        return None
+    return store.published(f"stats:{lot}")
+
+
+def lots_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for lot list command and button."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        if update.callback_query is not None:
+            update.callback_query.answer()
+        update.effective_message.reply_text(
+            "Выберите парковку", reply_markup=make_lots_keyboard(context)
+        )
+        log_event(update, "Запросил список парковок")
+
+
+def page_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for filter and page buttons of grid keyboard."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        user_id = str(update.effective_user.id)
+        try:
+            lot, view, page = parse_page_data(context, update.callback_query.data)
+        except StaleError:
+            update.callback_query.answer(
+                "Используйте клавиатуру из последнего сообщения!"
+            )
+            log_event(update, "Листал старую клавиатуру")
+            return
+        keyboard_views[user_id] = (lot, view, page)
+        update.callback_query.answer()
+        markup = make_keyboard(context, lot, user_id)
+        try:
+            update.callback_query.edit_message_reply_markup(reply_markup=markup)
+        except BadRequest as error:
+            if "not modified" not in error.message:
+                raise
+        # Keyboard of status message is changed, text is the same
+        last = context.bot_data["messages"].get(user_id)
+        if last is not None and last["id"] == update.callback_query.message.message_id:
+            context.bot_data["messages"][user_id] = dict(
+                last, markup=make_digest("", markup)[1]
+            )
+        log_event(update, f"Открыл страницу {page + 1} ({view}) клавиатуры")
+
+
+def lot_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for lot selection buttons."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        try:
+            lot = parse_lot_data(context, update.callback_query.data)
+        except StaleError:
+            update.callback_query.answer("Такой парковки больше нет")
+            log_event(update, "Выбрал несуществующую парковку")
+            return
+        subscribe(context, str(update.effective_user.id), lot)
+        update.callback_query.answer(f"Вы выбрали парковку {lot}")
+        send_status(update, context, lot)
+        log_event(update, f"Выбрал парковку {lot}")
+
+
+def notify_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for notification mode command."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        mode = user_mode(context, str(update.effective_user.id))
+        keyboard = [
+            [
+                InlineKeyboardButton(
+                    ("✅ " if name == mode else "") + caption,
+                    callback_data=f"notify.{name}",
+                )
+            ]
+            for name, caption in NOTIFY_MODES.items()
+        ]
+        update.effective_message.reply_text(
+            "Какие уведомления присылать?",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+        log_event(update, "Запросил режим уведомлений")
+
+
+def notify_mode_handler(update: Update, context: CallbackContext) -> None:
+    """Handler for notification mode buttons."""
+    if (
+        config["whitelist"]
+        and str(update.effective_user.id) in users
+        or not config["whitelist"]
+    ):
+        manage_user(update, context)
+        mode = update.callback_query.data.split(".", 1)[1]
+        if mode not in NOTIFY_MODES:
+            update.callback_query.answer("Такого режима больше нет")
+            return
+        user_id = str(update.effective_user.id)
+        subscribe(context, user_id, current_lot(context, user_id), mode)
+        update.callback_query.answer(f"Уведомления: {NOTIFY_MODES[mode]}")
+        log_event(update, f"Выбрал уведомления {mode}")
+
+
 def manage_user(update: Update, context: CallbackContext, check=True) -> None:
     """Managing users.
 
@@ -270,23 +1527,56 @@ def manage_user(update: Update, context: CallbackContext, check=True) -> None:
             username = username.replace(ch, "")
         if user_id not in users or users[user_id] != username:
             users[user_id] = username
-            save_json(config["users_file"], users)
-            stats = context.bot_data["stats"]
-            stats.update_users(users)
+            save_user(user_id)
+            for stats in context.bot_data["stats"].values():
+                stats.update_users({user_id: username})
+            # Names in keyboard captions changed
+            keyboard_cache.clear()
             log_event(update, "Добавили пользователя")
+        # Single lot needs no choosing
+        lots = get_lots()
+        if len(lots) == 1 and user_lot(context, user_id) is None:
+            subscribe(context, user_id, next(iter(lots)))
     elif not check:
         users.pop(user_id)
-        save_json(config["users_file"], users)
+        save_user(user_id)
         log_event(update, "Удалили пользователя")
 
 
-def log_event(update: Update, action: str) -> None:
-    try:
-        username = f"{users[str(update.effective_user.id)]}"
-    except KeyError:
-        username = update.effective_user.username
+def log_event(update: Update, action: str, place: str = None) -> None:
+    if update is None:
+        # Changes made by timers
+        user_id, username = None, "Таймер"
+    else:
+        user_id = update.effective_user.id
+        try:
+            username = f"{users[str(user_id)]}"
+        except KeyError:
+            username = update.effective_user.username
     action = action.replace("*", "")
-    logger.log(INFO, f"{username} - {action}")
+    event = {"user_id": user_id, "user": username, "action": action}
+    if place is not None:
+        event["place"] = place
+    started = getattr(handler_timing, "started", None)
+    if started is not None:
+        event["latency_ms"] = round((perf_counter() - started) * 1000, 3)
+    logger.log(INFO, f"{username} - {action}", extra={"event": event})
+
+
+def instrument(callback: Callable) -> Callable:
+    """Times handler callback and remembers its start for log latency."""
+    timed = metrics.wrap(callback.__name__, callback)
+
+    @wraps(callback)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        handler_timing.started = perf_counter()
+        try:
+            sync_shared(context)
+            return timed(update, context)
+        finally:
+            handler_timing.started = None
+
+    return wrapper
 
 
 def load_json(filename: str) -> dict:
@@ -298,19 +1588,158 @@ def load_json(filename: str) -> dict:
         exit(f'File "{filename}" does not exist')
 
 
-def save_json(filename: str, data: dict) -> None:
-    with open(filename, "w") as file:
-        dump(data, file, indent=4, sort_keys=True)
-
-
-def get_config() -> dict:
+def get_config_file() -> str:
     parser = ArgumentParser(prog="Logrocon Parking Bot v.3")
     parser.add_argument(
         "-c", "--config", default="config.json", metavar="C", help="config file name"
     )
     args = vars(parser.parse_args())
-    config = load_json(args["config"])
-    return config
+    return args["config"]
+
+
+def setup(config_file: str) -> None:
+    """Reads config and users, starts logging and makes background workers.
+
+    Nothing is read or started on import, so bot module is imported fast
+    and can be set up with other config (by benchmarks).
+
+    Raises:
+        ValueError: if data file isn't SQLite database.
+    """
+    global config_path, users_writer, broadcaster, coalescer, store
+    config_path = config_file
+    config.update(load_json(config_file))
+    check_database(config["data_file"])
+    users.update(load_json(config["users_file"]))
+    users_writer = JsonWriter(config["users_file"], config.get("users_write_delay", 1))
+    configure_logging()
+    # Queued records keep only message, listener handlers format them
+    basicConfig(
+        format="%(message)s", level=INFO, handlers=[QueueHandler(log_queue), log_buffer]
+    )
+    apply_config()
+    broadcast_config = config.get("broadcast", {})
+    broadcaster = Broadcaster(
+        workers=broadcast_config.get("workers", 8),
+        rate=broadcast_config.get("rate", 30),
+        chat_rate=broadcast_config.get("chat_rate", 1),
+        retries=broadcast_config.get("retries", 3),
+        on_unauthorized=drop_user,
+        metrics=metrics,
+    )
+    metrics.gauge("broadcast_queue", lambda: broadcaster.queue_size)
+    coalesce_config = config.get("coalesce", {})
+    coalescer = Coalescer(
+        flush_digest,
+        coalesce_config.get("window", 0),
+        coalesce_config.get("max_batch", 20),
+    )
+    metrics.gauge("coalesce_pending", lambda: len(coalescer))
+    if config.get("shared", {}).get("enabled"):
+        store = SharedStore(config["data_file"], f"{gethostname()}:{getpid()}")
+        metrics.gauge("leader", lambda: int(leadership.is_set()))
+
+
+def apply_config() -> None:
+    """Takes option groups used by handlers from config."""
+    global keyboard_config, charts_config, webhook_config
+    keyboard_config = config.get("keyboard", {})
+    charts_config = config.get("charts", {})
+    webhook_config = config.get("webhook", {})
+
+
+def configure_logging() -> None:
+    """Makes log file handlers by config and replaces listener writing them.
+
+    Records logged while listeners are replaced wait in the queue.
+    """
+    global log_file_handler, log_listener
+    logging_config = config["logging"]
+    log_buffer.capacity = logging_config.get("buffer_length", 1000)
+    files = [(logging_config["log_file"], Formatter(log_format))]
+    if logging_config.get("json_file"):
+        files.append((logging_config["json_file"], JsonFormatter()))
+    handlers = []
+    for filename, formatter in files:
+        handlers.append(
+            BatchingFileHandler(
+                filename,
+                capacity=logging_config.get("batch_size", 100),
+                interval=logging_config.get("flush_interval", 1),
+                maxBytes=logging_config.get("max_bytes", 10 * 1024 * 1024),
+                backupCount=logging_config.get("backup_count", 5),
+            )
+        )
+        handlers[-1].setFormatter(formatter)
+    listener = BatchingQueueListener(
+        log_queue, *handlers, interval=logging_config.get("flush_interval", 1)
+    )
+    if log_listener is not None:
+        log_listener.stop()
+    log_file_handler, log_listener = handlers[0], listener
+    log_listener.start()
+
+
+def reload_config(context: CallbackContext) -> str:
+    """Rereads config and users files without restart.
+
+    Places of lots are reconciled keeping state of places still in
+    config, whitelist, users, logging, keyboard, charts and timers
+    options take effect at once. Token, data files, webhook, workers,
+    broadcast and coalescing options need restart.
+
+    Returns:
+        str: text of reload result.
+    """
+    with reload_lock:
+        try:
+            with open(config_path) as file:
+                new_config = load(file)
+            check_config(new_config)
+            with open(new_config["users_file"]) as file:
+                new_users = load(file)
+        except (OSError, ValueError, KeyError) as error:
+            logger.log(INFO, f"Конфигурация не перечитана: {error!r}")
+            return f"Конфигурация не перечитана: {error!r}"
+        # Handlers and pending write of users file read the same dicts
+        replace_items(config, new_config)
+        apply_config()
+        configure_logging()
+        # Keyboard cache is cleared here for keyboard options too
+        refresh_users(context, new_users)
+        changes = reconcile_lots(context)
+        scheduler.cancel("clear")
+        schedule_clear(context)
+        lines = ["Конфигурация перечитана"]
+        for lot, (added, retired) in changes.items():
+            info = (
+                f"Места изменены: добавлено {len(added)}, убрано {len(retired)}"
+                + make_lot_suffix(lot)
+            )
+            owners = [place.occupant for place in retired if place.occupant]
+            update_state(None, context, lot, info, freed=bool(owners), owners=owners)
+            lines.append(info.replace("*", ""))
+        context.dispatcher.update_persistence()
+        logger.log(INFO, " ".join(lines))
+        return "\n".join(lines)
+
+
+def replace_items(target: dict, source: dict) -> None:
+    """Makes dict equal to source in place, without removing keys still
+    in source, so other threads never miss them."""
+    target.update(source)
+    for key in list(target):
+        if key not in source:
+            target.pop(key, None)
+
+
+def reload_handler(update: Update, context: CallbackContext) -> None:
+    """Rereading config by bot owner."""
+    if update.effective_user.id == config["owner_id"]:
+        update.effective_message.reply_text(reload_config(context))
+        log_event(update, "Перечитал конфигурацию")
+    else:
+        log_event(update, "Отправил reload, хотя не должен о ней знать")
 
 
 def toggle_whitelist(update: Update, context: CallbackContext) -> None:
@@ -334,12 +1763,22 @@ def get_logs(update: Update, context: CallbackContext) -> None:
         else:
             length = context.args[0]
             log_event(update, f"Отправил logs с аргументом {length}")
-        result = run(
-            ["tail", "-n", length, config["logging"]["log_file"]],
-            capture_output=True,
-            universal_newlines=True,
-        )
-        log = result.stdout
+        try:
+            length = int(length)
+        except ValueError:
+            update.effective_message.reply_text("Укажите количество строк числом")
+            return
+        if length <= len(log_buffer):
+            lines = log_buffer.tail(length)
+        else:
+            # Lines still batched in memory are written first
+            log_file_handler.sync()
+            lines = tail_rotated(
+                config["logging"]["log_file"],
+                length,
+                config["logging"].get("backup_count", 5),
+            )
+        log = "\n".join(lines) or "Лог пуст"
         if len(log) > 4096:
             for x in range(0, len(log), 4096):
                 update.effective_message.reply_text(log[x : x + 4096])
@@ -349,13 +1788,30 @@ def get_logs(update: Update, context: CallbackContext) -> None:
         log_event(update, "Отправил logs, хотя не должен о ней знать")
 
 
+def get_metrics(update: Update, context: CallbackContext) -> None:
+    """Getting bot metrics by message from bot by bot owner."""
+    if update.effective_user.id == config["owner_id"]:
+        update.effective_message.reply_text(metrics.summary or "Метрик пока нет")
+        log_event(update, "Запросил метрики")
+    else:
+        log_event(update, "Отправил metrics, хотя не должен о ней знать")
+
+
 def get_stats(update: Update, context: CallbackContext) -> None:
-    """Getting statistics by message from bot by bot owner."""
+    """Getting statistics and events by file from bot by bot owner."""
     if update.effective_user.id == config["owner_id"]:
-        update.effective_message.reply_text(
-            dumps(context.bot_data["stats"].as_dict, indent=4)
-        )
-        log_event(update, "Экспортировал статистику в json")
+        file_format = context.args[0] if context.args else FORMATS[0]
+        if file_format not in FORMATS:
+            update.effective_message.reply_text("Укажите формат: " + ", ".join(FORMATS))
+            log_event(update, "Отправил get_stats с неверным форматом")
+            return
+        lot = current_lot(context, str(update.effective_user.id))
+        filename = "-".join(filter(None, ["stats", lot])) + f".{file_format}"
+        with TemporaryFile() as file:
+            export_stats(context.bot_data["stats"][lot], file, file_format)
+            file.seek(0)
+            update.effective_message.reply_document(file, filename=filename)
+        log_event(update, f"Экспортировал статистику в {file_format}")
     else:
         log_event(update, "Отправил get_stats, хотя не должен о ней знать")
 
@@ -364,66 +1820,286 @@ def set_stats(update: Update, context: CallbackContext) -> None:
     """Setting statistics by message from bot owner to bot."""
     if update.effective_user.id == config["owner_id"]:
         if not context.args:
-            update.effective_message.reply_text("Отсутствуют аргументы")
+            update.effective_message.reply_text(
+                "Отправьте файл статистики с подписью /set_stats"
+            )
             log_event(update, f"Отправил set_stats без аргументов")
         else:
-            stats = ""
-            for item in context.args:
-                stats = stats + " " + item
-            context.bot_data["stats"].as_dict = loads(stats)
+            text = update.effective_message.text.split(maxsplit=1)[1]
+            try:
+                stats = read_stats(text)
+            except ValueError as error:
+                update.effective_message.reply_text(
+                    f"Статистика не импортирована: {error}"
+                )
+                log_event(update, f"Отправил неверный json статистики: {error}")
+                return
+            lot = current_lot(context, str(update.effective_user.id))
+            context.bot_data["stats"][lot].as_dict = stats
             update.effective_message.reply_text("Статистика импортирована")
             log_event(update, "Импортировал статистику из json")
     else:
         log_event(update, "Отправил set_stats, хотя не должен о ней знать")
 
 
-config = get_config()
-"""dict: all config options."""
+def set_stats_file(update: Update, context: CallbackContext) -> None:
+    """Merging statistics and events from file sent by bot owner."""
+    if update.effective_user.id == config["owner_id"]:
+        document = update.effective_message.document
+        file_format = (document.file_name or "").rpartition(".")[2].lower()
+        if file_format not in FORMATS:
+            update.effective_message.reply_text(
+                "Файл должен быть в формате " + ", ".join(FORMATS)
+            )
+            log_event(update, "Отправил файл статистики в неверном формате")
+            return
+        lot = current_lot(context, str(update.effective_user.id))
+        with TemporaryFile() as file:
+            document.get_file().download(out=file)
+            file.seek(0)
+            try:
+                result = import_stats(context.bot_data["stats"][lot], file, file_format)
+            except ValueError as error:
+                update.effective_message.reply_text(
+                    f"Статистика не импортирована: {error}"
+                )
+                log_event(update, f"Отправил неверный файл статистики: {error}")
+                return
+        update.effective_message.reply_text(
+            "Статистика импортирована: "
+            + f'пользователей {result["users"]}, счетчиков {result["counters"]}, '
+            + f'событий {result["events"]}, пропущено событий {result["skipped"]}'
+        )
+        log_event(update, f"Импортировал статистику из {file_format}")
+    else:
+        log_event(update, "Отправил файл статистики, хотя не должен о нем знать")
+
+
+def start_webhook(updater: Updater) -> WebhookServer:
+    """Starts dispatcher and server receiving updates by webhook."""
+    if not webhook_config.get("secret_token"):
+        exit("Webhook mode needs secret_token")
+    server = WebhookServer(
+        updater.bot,
+        updater.update_queue,
+        webhook_config["secret_token"],
+        path=webhook_config.get("path", "/"),
+        workers=webhook_config.get("workers", 4),
+        metrics=metrics,
+    )
+    server.serve(
+        webhook_config.get("port", 8443), webhook_config.get("listen", "0.0.0.0")
+    )
+    # Updater stops dispatcher on signals only if it's running
+    updater.running = True
+    Thread(target=updater.dispatcher.start, name="dispatcher").start()
+    updater.bot.set_webhook(
+        url=webhook_config["url"],
+        # Updates pending for other processes of shared mode are kept
+        drop_pending_updates=store is None,
+        secret_token=webhook_config["secret_token"],
+    )
+    return server
+
+
+CANCEL_SIGN = emojize(":right_arrow_curving_left:")
+CANCEL_CAPTION = " ".join([CANCEL_SIGN, "Отменить резерв"])
+CLEAR_CAPTION = " ".join([emojize(":FREE_button:"), "Очистить парковку"])
+STATISTICS_CAPTION = " ".join([emojize(":bar_chart:"), "Статистика"])
+LOTS_CAPTION = " ".join([emojize(":P_button:"), "Другая парковка"])
+VIEW_CAPTIONS = {"all": "Все", "free": "Свободные", "mine": "Мои"}
+NOTIFY_MODES = {
+    "all": "все изменения",
+    "free": "освободившиеся места",
+    "mine": "мои места",
+    "off": "без уведомлений",
+}
+
+keyboard_cache = {}
+"""dict: shared keyboard skeletons of current parking versions by lot."""
+
+keyboard_views = {}
+"""dict: lot, filter and page of user's grid keyboard."""
+
+chart_cache = {}
+"""dict: stats version, charts image and its file id by lot."""
+
+chart_lock = Lock()
+"""Lock: renders charts of new statistics version once."""
+
+
+config = {}
+"""dict: all config options, read by `setup`."""
 
-users = load_json(config["users_file"])
+config_path = None
+"""str: config file name."""
+
+reload_lock = Lock()
+"""Lock: serializes config reloads."""
+
+users = {}
 """dict: bot users."""
 
-# Set logging
+users_writer = None
+"""JsonWriter: writes users file in background."""
+
+blocked = set()
+"""set: users that blocked the bot, skipped by broadcasts until /start."""
+
 log_format = "%(asctime)s %(levelname)s %(name)s %(message)s"
-basicConfig(filename=config["logging"]["log_file"], format=log_format, level=INFO)
+log_buffer = RingBufferHandler()
+"""RingBufferHandler: last log lines for /logs."""
+log_buffer.setFormatter(Formatter(log_format))
+log_queue = SimpleQueue()
+log_file_handler = None
+"""BatchingFileHandler: writes text log file."""
+log_listener = None
+"""BatchingQueueListener: writes log files in background."""
 logger = getLogger(__name__)
+handler_timing = local()
+"""local: start time of handler running in current thread."""
+
+metrics = Metrics()
+"""Metrics: handlers timings and broadcast counters."""
+
+keyboard_config = {}
+
+charts_config = {}
+
+webhook_config = {}
+
+broadcaster = None
+"""Broadcaster: sends notifications in background."""
+
+scheduler = Scheduler(run_timers)
+"""Scheduler: reserve expiry and nightly clear timers."""
+metrics.gauge("timers", lambda: len(scheduler))
+
+coalescer = None
+"""Coalescer: merges bulk notifications of lot made within window."""
+
+store = None
+"""SharedStore: state shared by bot processes, None for single process."""
+
+shared_versions = {}
+"""dict: versions of shared data this process has taken."""
+
+shared_lock = Lock()
+"""Lock: syncs shared data and takes versions of own writes one at a time."""
+
+leadership = Event()
+"""Event: is set while process is leader of shared mode."""
+
+shared_stop = Event()
+"""Event: stops leader loop of shared mode."""
 
 handlers = [
-    CommandHandler("start", start),
-    CommandHandler("stop", stop),
-    CallbackQueryHandler(cancel_handler, pattern="cancel.*"),
-    CallbackQueryHandler(clear_handler, pattern="clear"),
-    CallbackQueryHandler(statistics_handler, pattern="statistics"),
-    CallbackQueryHandler(parking_handler),
-    CommandHandler("whitelist", toggle_whitelist),
-    CommandHandler("logs", get_logs, pass_args=True),
-    CommandHandler("get_stats", get_stats),
-    CommandHandler("set_stats", set_stats, pass_args=True),
+    CommandHandler("start", start, run_async=True),
+    CommandHandler("stop", stop, run_async=True),
+    CallbackQueryHandler(cancel_handler, pattern=r"cancel\.", run_async=True),
+    CallbackQueryHandler(clear_handler, pattern=r"clear\.", run_async=True),
+    CallbackQueryHandler(statistics_handler, pattern=r"statistics\.", run_async=True),
+    CallbackQueryHandler(lot_handler, pattern=r"lot\.", run_async=True),
+    CallbackQueryHandler(page_handler, pattern=r"page\.", run_async=True),
+    CallbackQueryHandler(lots_handler, pattern="lots$", run_async=True),
+    CallbackQueryHandler(notify_mode_handler, pattern=r"notify\.", run_async=True),
+    CallbackQueryHandler(parking_handler, run_async=True),
+    CommandHandler("lot", lots_handler, run_async=True),
+    CommandHandler("notify", notify_handler, run_async=True),
+    CommandHandler("stats", period_statistics_handler, pass_args=True, run_async=True),
+    CommandHandler("whitelist", toggle_whitelist, run_async=True),
+    CommandHandler("logs", get_logs, pass_args=True, run_async=True),
+    CommandHandler("metrics", get_metrics, run_async=True),
+    CommandHandler("reload", reload_handler, run_async=True),
+    CommandHandler("get_stats", get_stats, run_async=True),
+    CommandHandler("set_stats", set_stats, pass_args=True, run_async=True),
+    MessageHandler(
+        Filters.document & Filters.caption_regex(r"^/set_stats"),
+        set_stats_file,
+        run_async=True,
+    ),
 ]
 
 
 def main():
+    try:
+        setup(get_config_file())
+        check_config(config)
+    except ValueError as error:
+        exit(str(error))
+    if store is not None and not webhook_config.get("url"):
+        exit("Shared mode needs webhook, long polling can't be shared")
     updater = Updater(
         token=config["token"],
-        persistence=PicklePersistence(
-            filename=config["data_file"],
-            store_chat_data=False,
-            store_user_data=False,
-            on_flush=False,
+        workers=config.get("workers", 8),
+        persistence=SQLitePersistence(
+            config["data_file"], config.get("legacy_data_file"), metrics
         ),
     )
     dispatcher = updater.dispatcher
-    dispatcher.bot_data["stats"] = dispatcher.bot_data.get("stats", Stats(users))
-    dispatcher.bot_data["parking"] = dispatcher.bot_data.get(
-        "parking", Parking(config["places"])
+    bot_data = dispatcher.bot_data
+    lots = get_lots()
+    parkings = bot_data.setdefault("parking", {})
+    all_stats = bot_data.setdefault("stats", {})
+    bot_data.setdefault("messages", {})
+    # Users of older bot are subscribed to first lot
+    subscribers = bot_data.setdefault(
+        "subscribers", {next(iter(lots)): {"all": set(users)}}
     )
-    # Create new parking if places in config changed
-    if [x[2] for x in dispatcher.bot_data["parking"].state] != config["places"]:
-        dispatcher.bot_data["parking"] = Parking(config["places"])
+    # Single parking of older bot becomes first lot
+    if "" not in lots:
+        for data in (parkings, all_stats, subscribers):
+            if "" in data:
+                data.setdefault(next(iter(lots)), data.pop(""))
+    # Places changed in config keep state of the rest
+    context = CallbackContext(dispatcher)
+    if store is not None:
+        share_bot_data(context)
+    reconcile_lots(context)
+    # Timers of reserves made before restart
+    for lot, parking in parkings.items():
+        for place in parking.places:
+            if place.state == "reserved":
+                schedule_expiry(context, lot, place.snapshot)
+    schedule_clear(context)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: Thread(
+                target=reload_config, args=(context,), name="reload"
+            ).start(),
+        )
     for handler in handlers:
+        handler.callback = instrument(handler.callback)
         dispatcher.add_handler(handler)
-    updater.start_polling(drop_pending_updates=True)
+    metrics.gauge("update_queue", updater.update_queue.qsize)
+    if config.get("metrics_port"):
+        metrics.serve(config["metrics_port"])
+    broadcaster.start(updater.bot)
+    scheduler.start()
+    coalescer.start()
+    shared_thread = None
+    if store is not None:
+        shared_thread = Thread(target=run_shared, args=(context,), name="shared")
+        shared_thread.start()
+    webhook = None
+    if webhook_config.get("url"):
+        webhook = start_webhook(updater)
+    else:
+        updater.start_polling(drop_pending_updates=True)
     updater.idle()
+    if webhook is not None:
+        webhook.stop()
+    if shared_thread is not None:
+        shared_stop.set()
+        shared_thread.join()
+    scheduler.stop()
+    coalescer.stop()
+    broadcaster.stop()
+    users_writer.flush()
+    # Save status messages sent after last update
+    dispatcher.update_persistence()
+    log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+from logging import getLogger
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError, TimedOut, Unauthorized
+
+from .metrics import Metrics
+
+logger = getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread safe token bucket for rate limiting.
+
+    Attributes:
+        rate: tokens added per second.
+        capacity: maximum tokens (burst size).
+    """
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = monotonic()
+        self.__lock = Lock()
+
+    def acquire(self) -> None:
+        """Take one token, sleeping until it is available."""
+        while True:
+            with self.__lock:
+                now = monotonic()
+                self.__tokens = min(
+                    self.__capacity,
+                    self.__tokens + (now - self.__updated) * self.__rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.__rate
+            sleep(wait)
+
+
+class Broadcaster:
+    """Sending messages to many chats in parallel.
+
+    Jobs are sharded between workers by chat id, so messages for one
+    chat keep their order while different chats are served concurrently.
+    Every API call takes a token from global and per-chat buckets.
+
+    Attributes:
+        workers: number of worker threads.
+        rate: global messages per second limit.
+        chat_rate: per-chat messages per second limit.
+        retries: how many times to retry a call on flood or timeout.
+        on_unauthorized: called with chat id if user blocked the bot.
+        metrics (optional): for counting sent and failed calls.
+    """
+    def __init__(self, workers: int = 8, rate: float = 30,
+                 chat_rate: float = 1, retries: int = 3,
+                 on_unauthorized=None, metrics: Metrics = None) -> None:
+        self.__queues = [Queue() for _ in range(workers)]
+        self.__threads = []
+        self.__bucket = TokenBucket(rate, rate)
+        self.__chat_rate = chat_rate
+        self.__chat_buckets = {}
+        self.__chat_lock = Lock()
+        self.__retries = retries
+        self.__on_unauthorized = on_unauthorized
+        self.__metrics = metrics or Metrics()
+        self.__bot = None
+
+    @property
+    def bot(self) -> Bot:
+        return self.__bot
+
+    @property
+    def queue_size(self) -> int:
+        """Jobs waiting to be sent."""
+        return sum(queue.qsize() for queue in self.__queues)
+
+    def start(self, bot: Bot) -> None:
+        """Start worker threads.
+
+        Args:
+            bot: bot for making API calls.
+        """
+        self.__bot = bot
+        for num, queue in enumerate(self.__queues):
+            thread = Thread(target=self.__work, args=(queue,),
+                            name=f'broadcast_{num}', daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self) -> None:
+        """Send everything already enqueued and stop workers."""
+        for queue in self.__queues:
+            queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def submit(self, chat_id: str, job) -> None:
+        """Enqueue job for chat.
+
+        Args:
+            chat_id: chat the job sends to.
+            job: callable without arguments, should make API calls
+            through `call`.
+        """
+        self.__queues[hash(chat_id) % len(self.__queues)].put(
+            (chat_id, job))
+
+    def call(self, chat_id: str, method, /, *args, **kwargs):
+        """Make rate limited API call with retries.
+
+        Args:
+            chat_id: chat for per-chat rate limit.
+            method: bot method to call.
+
+        Raises:
+            TelegramError: if call still fails after all retries.
+
+        Returns:
+            whatever method returns.
+        """
+        attempt = 0
+        while True:
+            self.__bucket.acquire()
+            self.__chat_bucket(chat_id).acquire()
+            try:
+                result = method(*args, **kwargs)
+                self.__metrics.inc('messages_sent')
+                return result
+            except RetryAfter as error:
+                self.__metrics.inc('messages_rate_limited')
+                if attempt >= self.__retries:
+                    raise
+                sleep(error.retry_after)
+            except TimedOut:
+                self.__metrics.inc('messages_timed_out')
+                if attempt >= self.__retries:
+                    raise
+                sleep(2 ** attempt)
+            attempt += 1
+
+    def __chat_bucket(self, chat_id: str) -> TokenBucket:
+        with self.__chat_lock:
+            bucket = self.__chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.__chat_rate, 3)
+                self.__chat_buckets[chat_id] = bucket
+            return bucket
+
+    def __work(self, queue: Queue) -> None:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            chat_id, job = item
+            try:
+                with self.__metrics.timer('broadcast_job'):
+                    job()
+            except Unauthorized:
+                self.__metrics.inc('users_blocked')
+                if self.__on_unauthorized is not None:
+                    self.__on_unauthorized(chat_id)
+            except TelegramError as error:
+                self.__metrics.inc('messages_failed')
+                logger.error(f'Не удалось отправить сообщение {chat_id}: '
+                             f'{error}')
+            except Exception:
+                self.__metrics.inc('messages_failed')
+                logger.exception(f'Ошибка рассылки {chat_id}')
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+from importlib.util import find_spec
+from io import BytesIO
+
+from .events import EventLog
+
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+"""tuple: weekday labels of heatmap."""
+
+
+def available() -> bool:
+    """Are NumPy and Matplotlib installed.
+
+    They are optional and imported only while rendering, so bot without
+    them just has no charts.
+    """
+    return all(find_spec(name) is not None
+               for name in ('numpy', 'matplotlib'))
+
+
+def render_charts(log: EventLog, places: int, since: datetime,
+                  until: datetime, curves: int = 10) -> bytes:
+    """PNG image with occupancy charts for period.
+
+    Hour of day by weekday heatmap shows average part of lot occupied in
+    that hour, curves show part of day every place was occupied, for
+    places occupied most.
+
+    Args:
+        log: event log with occupations.
+        places: number of places in lot.
+        since: start of period.
+        until: end of period.
+        curves (optional): max number of place curves.
+
+    Returns:
+        bytes: PNG image, None if there were no occupations in period.
+    """
+    import numpy as np
+    from matplotlib.figure import Figure
+
+    rows = log.occupations(since)
+    if not rows or places == 0:
+        return None
+    numbers = np.array([row[0] for row in rows])
+    origin = since.replace(minute=0, second=0, microsecond=0)
+    starts = np.array([row[1] for row in rows]) - origin.timestamp()
+    ends = np.array([row[2] for row in rows]) - origin.timestamp()
+    duration = (until - origin).total_seconds()
+
+    hours = int(np.ceil(duration / 3600))
+    seconds = occupied_seconds(starts, ends, np.arange(hours + 1) * 3600.0)
+    hour = origin.hour + np.arange(hours)
+    cells = ((origin.weekday() + hour // 24) % 7, hour % 24)
+    heatmap = np.zeros((7, 24))
+    counts = np.zeros((7, 24))
+    np.add.at(heatmap, cells, seconds)
+    np.add.at(counts, cells, 1)
+    heatmap /= np.maximum(counts, 1) * 3600 * places
+
+    days = int(np.ceil(duration / 86400))
+    bounds = np.arange(days + 1) * 86400.0
+    dates = [origin + timedelta(days=day) for day in range(days)]
+    totals = {number: (ends[numbers == number]
+                       - starts[numbers == number]).sum()
+              for number in np.unique(numbers)}
+    top = sorted(totals, key=totals.get, reverse=True)[:curves]
+
+    figure = Figure(figsize=(9, 9), tight_layout=True)
+    heat_axes, curve_axes = figure.subplots(2, 1)
+    image = heat_axes.imshow(heatmap, aspect='auto', cmap='Reds', vmin=0,
+                             vmax=max(heatmap.max(), 0.01))
+    heat_axes.set_title('Занятость парковки по часам')
+    heat_axes.set_xticks(range(0, 24, 2))
+    heat_axes.set_xlabel('Час')
+    heat_axes.set_yticks(range(7))
+    heat_axes.set_yticklabels(WEEKDAYS)
+    figure.colorbar(image, ax=heat_axes)
+    for number in top:
+        mask = numbers == number
+        curve_axes.plot(dates, occupied_seconds(
+            starts[mask], ends[mask], bounds) / 86400, label=str(number))
+    curve_axes.set_title('Занятость мест по дням')
+    curve_axes.set_ylim(0, 1)
+    curve_axes.legend(loc='upper left', fontsize='small', ncol=2)
+    curve_axes.tick_params(axis='x', labelrotation=30)
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png', dpi=100)
+    return buffer.getvalue()
+
+
+def occupied_seconds(starts, ends, bounds):
+    """Total occupied seconds of intervals in bins between bounds.
+
+    Integral of occupied places number is counted at every bound by
+    sorted starts and ends of intervals, so it doesn't depend on number
+    of intervals in bin.
+
+    Args:
+        starts: array of interval starts.
+        ends: array of interval ends.
+        bounds: sorted array of bin bounds.
+
+    Returns:
+        array: seconds for every bin.
+    """
+    import numpy as np
+
+    def integral(points):
+        points = np.sort(points)
+        sums = np.concatenate(([0.0], np.cumsum(points)))
+        passed = np.searchsorted(points, bounds)
+        return passed * bounds - sums[passed]
+
+    return np.diff(integral(starts) - integral(ends))
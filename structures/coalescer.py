@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Lock
+
+from .scheduler import Scheduler
+
+logger = getLogger(__name__)
+
+
+class Coalescer:
+    """Merges items added by key within time window into batches.
+
+    First item of key starts window, when it's over or batch of key is
+    full, all items of key are passed to flush at once. So burst of
+    changes costs one notification instead of one per change.
+
+    Attributes:
+        flush: called with key and list of its items, in scheduler
+        thread for expired windows, in adding thread for full batches.
+        window: seconds to collect items for, 0 is off.
+        max_batch (optional): items to flush batch before window is over,
+        0 is no limit.
+    """
+    def __init__(self, flush, window: float, max_batch: int = 0) -> None:
+        self.__flush = flush
+        self.__window = window
+        self.__max_batch = max_batch
+        self.__batches = {}
+        self.__lock = Lock()
+        self.__scheduler = Scheduler(self.__expire, window=0)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(len(batch) for batch in self.__batches.values())
+
+    @property
+    def enabled(self) -> bool:
+        return self.__window > 0
+
+    def add(self, key, item) -> None:
+        """Add item to batch of key."""
+        with self.__lock:
+            batch = self.__batches.setdefault(key, [])
+            batch.append(item)
+            if self.__max_batch and len(batch) >= self.__max_batch:
+                del self.__batches[key]
+                self.__scheduler.cancel(key)
+            else:
+                if len(batch) == 1:
+                    self.__scheduler.schedule(key, datetime.now() + timedelta(
+                        seconds=self.__window))
+                return
+        self.__flush(key, batch)
+
+    def start(self) -> None:
+        self.__scheduler.start()
+
+    def stop(self) -> None:
+        """Stop window timers and flush all pending batches."""
+        self.__scheduler.stop()
+        with self.__lock:
+            batches, self.__batches = self.__batches, {}
+        for key, batch in batches.items():
+            self.__call(key, batch)
+
+    def __expire(self, due: list) -> None:
+        for key, _ in due:
+            with self.__lock:
+                batch = self.__batches.pop(key, None)
+            if batch:
+                self.__call(key, batch)
+
+    def __call(self, key, batch: list) -> None:
+        try:
+            self.__flush(key, batch)
+        except Exception:
+            logger.exception('Ошибка отправки пакета')
@@ -0,0 +1,222 @@
+from datetime import date, datetime, timedelta
+from sqlite3 import connect
+from threading import Lock
+
+ACTIONS = ('reserve', 'occupy', 'free', 'cancel')
+"""tuple: logged actions, stored by index."""
+
+PERIODS = {
+    'day': lambda day: day.isoformat(),
+    'month': lambda day: day.strftime('%Y-%m'),
+}
+"""dict: bucket name makers for rollup periods."""
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    action INTEGER NOT NULL,
+    place TEXT NOT NULL,
+    person TEXT,
+    duration REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, dimension, bucket, key)
+) WITHOUT ROWID;
+'''
+
+
+class EventLog:
+    """Append-only log of place state changes.
+
+    Every event is stored in SQLite with indexed timestamp and is
+    added to day and month rollups of occupations count and
+    occupied time by place, by person and in total. So range queries
+    read rollups instead of replaying the log.
+
+    Attributes:
+        filename: SQLite database file.
+    """
+    def __init__(self, filename: str) -> None:
+        self.__connection = connect(filename, check_same_thread=False)
+        self.__lock = Lock()
+        with self.__lock, self.__connection:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.executescript(SCHEMA)
+
+    def append(self, action: str, place: str, person: str,
+               duration: float = 0.0, when: datetime = None) -> None:
+        """Write event to log and update rollups.
+
+        Occupations are counted by "occupy" events, occupied time
+        by "free" events.
+
+        Args:
+            action: one of ACTIONS.
+            place: place number.
+            person: user id of place occupant.
+            duration (optional): seconds place was occupied.
+            when (optional): event time, defaults to now.
+        """
+        with self.__lock, self.__connection:
+            self.__write(when or datetime.now(), action, place, person,
+                         duration)
+
+    def extend(self, events) -> int:
+        """Write several events in one transaction, see `append`.
+
+        Args:
+            events: iterable of tuples of time, action, place, person
+            and duration.
+
+        Returns:
+            int: number of written events.
+        """
+        count = 0
+        with self.__lock, self.__connection:
+            for when, action, place, person, duration in events:
+                self.__write(when, action, place, person, duration)
+                count += 1
+        return count
+
+    def totals(self, since: date = None, until: date = None) -> dict:
+        """Statistics dimensions for period.
+
+        Args:
+            since (optional): first day of period, unbounded if omitted.
+            until (optional): last day of period, unbounded if omitted.
+
+        Returns:
+            dict: places, persons, weekdays, monthes (as YYYY-MM)
+            counters and total_time, like `Stats.as_dict`.
+        """
+        since = since or date(1970, 1, 1)
+        until = until or date(9999, 12, 31)
+        totals = {'places': {}, 'persons': {}, 'weekdays': {},
+                  'monthes': {}, 'total_time': 0.0}
+        dimensions = {'place': totals['places'], 'person': totals['persons']}
+        with self.__lock:
+            for period, first, last in self.__ranges(since, until):
+                rows = self.__connection.execute(
+                    'SELECT dimension, key, SUM(count), SUM(seconds) '
+                    'FROM rollups WHERE period = ? AND bucket BETWEEN ? AND ? '
+                    'GROUP BY dimension, key', (period, first, last))
+                for dimension, key, count, seconds in rows:
+                    if dimension == 'total':
+                        totals['total_time'] += seconds
+                        continue
+                    counter = dimensions[dimension]
+                    counter[key] = counter.get(key, 0) + count
+            rows = self.__connection.execute(
+                "SELECT bucket, count FROM rollups WHERE period = 'day' "
+                "AND dimension = 'total' AND bucket BETWEEN ? AND ? "
+                "AND count > 0", (since.isoformat(), until.isoformat()))
+            for bucket, count in rows:
+                day = date.fromisoformat(bucket)
+                for counter, key in ((totals['weekdays'], day.strftime('%A')),
+                                     (totals['monthes'], bucket[:7])):
+                    counter[key] = counter.get(key, 0) + count
+        return totals
+
+    def events(self, since: datetime = None, until: datetime = None,
+               chunk: int = 1000):
+        """Iterate over logged events in time order.
+
+        Events are read by chunks, so log of any size can be iterated
+        without loading it to memory.
+
+        Args:
+            since (optional): start time, unbounded if omitted.
+            until (optional): end time, unbounded if omitted.
+            chunk (optional): events read at once.
+
+        Yields:
+            tuple: time, action, place, person and duration.
+        """
+        last = (since.timestamp() if since else float('-inf'), -1)
+        until = until.timestamp() if until else float('inf')
+        while True:
+            with self.__lock:
+                rows = self.__connection.execute(
+                    'SELECT id, ts, action, place, person, duration '
+                    'FROM events WHERE (ts > ? OR ts = ? AND id > ?) '
+                    'AND ts <= ? ORDER BY ts, id LIMIT ?',
+                    (last[0], last[0], last[1], until, chunk)).fetchall()
+            for _, ts, action, place, person, duration in rows:
+                yield (datetime.fromtimestamp(ts), ACTIONS[action], place,
+                       person, duration)
+            if len(rows) < chunk:
+                return
+            last = (rows[-1][1], rows[-1][0])
+
+    def occupations(self, since: datetime = None,
+                    until: datetime = None) -> list:
+        """Occupation intervals ended in period, from "free" events.
+
+        Returns:
+            list: tuples of place, start and end timestamps.
+        """
+        since = since.timestamp() if since else 0
+        until = until.timestamp() if until else float('inf')
+        with self.__lock:
+            return self.__connection.execute(
+                'SELECT place, ts - duration, ts FROM events '
+                'WHERE ts BETWEEN ? AND ? AND action = ?',
+                (since, until, ACTIONS.index('free'))).fetchall()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+    def __write(self, when: datetime, action: str, place: str, person: str,
+                duration: float) -> None:
+        self.__connection.execute(
+            'INSERT INTO events (ts, action, place, person, duration) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (when.timestamp(), ACTIONS.index(action), place, person,
+             duration))
+        if action == 'occupy':
+            self.__roll(when.date(), place, person, 1, 0.0)
+        elif action == 'free':
+            self.__roll(when.date(), place, person, 0, duration)
+
+    def __roll(self, day: date, place: str, person: str, count: int,
+               seconds: float) -> None:
+        for period, bucket in PERIODS.items():
+            for dimension, key in (('total', ''), ('place', place),
+                                   ('person', person)):
+                self.__connection.execute(
+                    'INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (period, dimension, bucket, key) DO UPDATE '
+                    'SET count = count + excluded.count, '
+                    'seconds = seconds + excluded.seconds',
+                    (period, dimension, bucket(day), key, count, seconds))
+
+    def __ranges(self, since: date, until: date) -> list:
+        """Split period to whole months and days at the edges."""
+        first = since if since.day == 1 else self.__next_month(since)
+        end = self.__next_month(until)
+        if end - timedelta(days=1) != until:
+            end = until.replace(day=1)
+        if first >= end:
+            return [('day', since.isoformat(), until.isoformat())]
+        ranges = [('month', PERIODS['month'](first),
+                   PERIODS['month'](end - timedelta(days=1)))]
+        if since < first:
+            ranges.append(('day', since.isoformat(),
+                           (first - timedelta(days=1)).isoformat()))
+        if end <= until:
+            ranges.append(('day', end.isoformat(), until.isoformat()))
+        return ranges
+
+    def __next_month(self, day: date) -> date:
+        if day.year == 9999 and day.month == 12:
+            return date.max
+        return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
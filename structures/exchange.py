@@ -0,0 +1,217 @@
+from csv import DictReader, DictWriter
+from datetime import datetime
+from io import TextIOWrapper
+from json import dumps, loads
+
+from .events import ACTIONS
+from .stats import Stats
+
+FORMATS = ('jsonl', 'csv')
+"""tuple: file formats of statistics export and import."""
+
+FIELDS = ('kind', 'dimension', 'key', 'value', 'time', 'action', 'place',
+          'person', 'duration')
+"""tuple: fields of records, record kind defines used ones."""
+
+COUNTERS = ('places', 'persons', 'weekdays', 'monthes')
+"""tuple: counter dimensions of statistics."""
+
+
+def export_stats(stats: Stats, file, file_format: str) -> int:
+    """Write statistics and its event log to file record by record.
+
+    Records are users, counters, total time and events, events are
+    streamed from log, so memory use doesn't depend on log size.
+
+    Args:
+        stats: statistics to export.
+        file: binary file to write to.
+        file_format: one of FORMATS.
+
+    Returns:
+        int: number of written records.
+    """
+    text = TextIOWrapper(file, encoding='utf-8', newline='')
+    if file_format == 'csv':
+        writer = DictWriter(text, FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(record: dict) -> None:
+            text.write(dumps(record, ensure_ascii=False) + '\n')
+    count = 0
+    for record in make_records(stats):
+        write(record)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+
+def make_records(stats: Stats):
+    """Records of statistics and its event log, see `export_stats`."""
+    yield from make_dict_records(stats.as_dict)
+    if stats.log is None:
+        return
+    for when, action, place, person, duration in stats.log.events():
+        yield {'kind': 'event', 'time': when.isoformat(), 'action': action,
+               'place': place, 'person': person, 'duration': duration}
+
+
+def make_dict_records(stats_dict: dict):
+    """Users, counters and total time records of dict like `as_dict`."""
+    for key, value in dict(stats_dict['users']).items():
+        yield {'kind': 'user', 'key': key, 'value': value}
+    for dimension in COUNTERS:
+        for key, value in dict(stats_dict[dimension]).items():
+            yield {'kind': 'counter', 'dimension': dimension, 'key': key,
+                   'value': value}
+    yield {'kind': 'total_time', 'value': stats_dict['total_time']}
+
+
+def read_stats(text: str) -> dict:
+    """Checked statistics from json like `Stats.as_dict`.
+
+    Values are checked by the same schema as records of files.
+
+    Returns:
+        dict: statistics to set to `as_dict`.
+
+    Raises:
+        ValueError: if json doesn't match schema.
+    """
+    stats_dict = {'users': {}, 'total_time': 0.0}
+    stats_dict.update((dimension, {}) for dimension in COUNTERS)
+    result = {'users': 0, 'counters': 0}
+    try:
+        for record in make_dict_records(loads(text)):
+            add_record(stats_dict, result, *check_record(record))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('json не соответствует формату статистики')
+    return stats_dict
+
+
+def import_stats(stats: Stats, file, file_format: str,
+                 chunk: int = 1000) -> dict:
+    """Merge statistics and events from file into statistics.
+
+    File is read twice: all records are checked first, so broken file
+    changes nothing, then counters are added to statistics and events
+    are written to its event log by chunks.
+
+    Args:
+        stats: statistics to merge to.
+        file: seekable binary file to read from.
+        file_format: one of FORMATS.
+        chunk (optional): events written at once.
+
+    Returns:
+        dict: numbers of imported users, counters and events and of
+        skipped events (if statistics has no event log).
+
+    Raises:
+        ValueError: if file has record not matching schema.
+    """
+    for _ in read_records(file, file_format):
+        pass
+    file.seek(0)
+    merged = {'users': {}, 'total_time': 0.0}
+    result = {'users': 0, 'counters': 0, 'events': 0, 'skipped': 0}
+    events = []
+    for kind, record in read_records(file, file_format):
+        if kind == 'event':
+            events.append(record)
+            if len(events) >= chunk:
+                write_events(stats, events, result)
+        else:
+            add_record(merged, result, kind, record)
+    write_events(stats, events, result)
+    stats.merge(merged)
+    return result
+
+
+def add_record(merged: dict, result: dict, kind: str, record: tuple) -> None:
+    """Add user, counter or total time record to merged statistics."""
+    if kind == 'user':
+        key, value = record
+        merged['users'][key] = value
+        result['users'] += 1
+    elif kind == 'counter':
+        dimension, key, value = record
+        counter = merged.setdefault(dimension, {})
+        counter[key] = counter.get(key, 0) + value
+        result['counters'] += 1
+    else:
+        merged['total_time'] += record
+
+
+def write_events(stats: Stats, events: list, result: dict) -> None:
+    """Write chunk of events to event log of statistics and clear it."""
+    if stats.log is None:
+        result['skipped'] += len(events)
+    else:
+        result['events'] += stats.log.extend(events)
+    events.clear()
+
+
+def read_records(file, file_format: str):
+    """Checked records from file.
+
+    Yields:
+        tuple: kind of record and record, see `check_record`.
+
+    Raises:
+        ValueError: with line number, if record doesn't match schema.
+    """
+    text = TextIOWrapper(file, encoding='utf-8', newline='')
+    try:
+        if file_format == 'csv':
+            reader = DictReader(text)
+            if reader.fieldnames is None or 'kind' not in reader.fieldnames:
+                raise ValueError('нет заголовка с полем kind')
+            lines = ((reader.line_num, row) for row in reader)
+        else:
+            lines = ((num, line) for num, line in enumerate(text, start=1)
+                     if line.strip())
+        for num, line in lines:
+            try:
+                record = line if file_format == 'csv' else loads(line)
+                yield check_record(record)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                raise ValueError(f'неверная запись в строке {num}')
+    finally:
+        text.detach()
+
+
+def check_record(record: dict) -> tuple:
+    """Check record schema and convert its values.
+
+    Returns:
+        tuple: kind and record: key and name for "user", dimension, key
+        and value for "counter", seconds for "total_time" and time,
+        action, place, person and duration for "event".
+
+    Raises:
+        ValueError: if record doesn't match schema.
+    """
+    kind = record['kind']
+    if kind == 'user':
+        return kind, (str(record['key']), str(record['value']))
+    if kind == 'counter':
+        value = int(record['value'])
+        if record['dimension'] not in COUNTERS or value < 0:
+            raise ValueError
+        return kind, (record['dimension'], str(record['key']), value)
+    if kind == 'total_time':
+        value = float(record['value'])
+        if value < 0:
+            raise ValueError
+        return kind, value
+    if kind == 'event':
+        if record['action'] not in ACTIONS or not record['place']:
+            raise ValueError
+        return kind, (datetime.fromisoformat(record['time']),
+                      record['action'], str(record['place']),
+                      str(record['person']) if record['person'] else None,
+                      float(record.get('duration') or 0))
+    raise ValueError
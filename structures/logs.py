@@ -0,0 +1,196 @@
+from collections import deque
+from json import dumps
+from logging import Formatter, Handler, LogRecord
+from logging.handlers import QueueListener, RotatingFileHandler
+from os import SEEK_END
+from os.path import exists, getsize
+from queue import Empty, Queue
+from threading import Lock
+from time import monotonic
+
+
+class RingBufferHandler(Handler):
+    """Logging handler keeping last lines of log in memory.
+
+    Attributes:
+        capacity (optional): how many lines to keep.
+    """
+    def __init__(self, capacity: int = 1000) -> None:
+        super().__init__()
+        self.__lines = deque(maxlen=capacity)
+        self.__lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.__lines)
+
+    @property
+    def capacity(self) -> int:
+        return self.__lines.maxlen
+
+    @capacity.setter
+    def capacity(self, capacity: int) -> None:
+        """Change capacity keeping last lines."""
+        with self.__lock:
+            self.__lines = deque(self.__lines, maxlen=capacity)
+
+    def emit(self, record: LogRecord) -> None:
+        try:
+            lines = self.format(record).splitlines()
+        except Exception:
+            self.handleError(record)
+            return
+        with self.__lock:
+            self.__lines.extend(lines)
+
+    def tail(self, length: int) -> list:
+        """Last lines of log."""
+        with self.__lock:
+            start = max(0, len(self.__lines) - length)
+            return [self.__lines[num] for num in
+                    range(start, len(self.__lines))]
+
+
+class BatchingFileHandler(RotatingFileHandler):
+    """Rotating file handler flushing file by batches of records.
+
+    File is flushed when `capacity` records are written or `interval`
+    seconds passed since last flush, or by `sync`. Size of file for
+    rotation is counted by written records, as base handler seeks file
+    for it and so flushes it on every record.
+
+    Attributes:
+        filename: log file.
+        capacity (optional): records in batch.
+        interval (optional): max seconds between flushes.
+    """
+    def __init__(self, filename: str, capacity: int = 100,
+                 interval: float = 1.0, **kwargs) -> None:
+        self.__capacity = capacity
+        self.__interval = interval
+        self.__pending = 0
+        self.__flushed = monotonic()
+        self.__size = None
+        super().__init__(filename, **kwargs)
+
+    def emit(self, record: LogRecord) -> None:
+        self.__pending += 1
+        super().emit(record)
+
+    def shouldRollover(self, record: LogRecord) -> bool:
+        if self.maxBytes <= 0:
+            return False
+        if self.__size is None:
+            self.__size = (getsize(self.baseFilename)
+                           if exists(self.baseFilename) else 0)
+        size = len((self.format(record) + self.terminator).encode(
+            self.encoding or 'utf-8', 'replace'))
+        if self.__size + size >= self.maxBytes:
+            # Record is written to new file after rollover
+            self.__size = size
+            return True
+        self.__size += size
+        return False
+
+    def flush(self) -> None:
+        # Called after every record, so flush only full batch
+        if (self.__pending >= self.__capacity
+                or monotonic() - self.__flushed >= self.__interval):
+            self.sync()
+
+    def sync(self) -> None:
+        """Flush file right now."""
+        super().flush()
+        self.__pending = 0
+        self.__flushed = monotonic()
+
+    def close(self) -> None:
+        self.sync()
+        super().close()
+
+
+class BatchingQueueListener(QueueListener):
+    """Queue listener flushing handlers when queue is idle.
+
+    Attributes:
+        queue: queue of QueueHandler.
+        handlers: handlers of records.
+        interval (optional): idle seconds before flush.
+    """
+    def __init__(self, queue: Queue, *handlers: Handler,
+                 interval: float = 1.0) -> None:
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.__interval = interval
+
+    def dequeue(self, block: bool) -> LogRecord:
+        while True:
+            try:
+                return self.queue.get(block, self.__interval)
+            except Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+    def stop(self) -> None:
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+class JsonFormatter(Formatter):
+    """Formats records as json lines.
+
+    Fields from `event` dict in record extra are added to json.
+    """
+    def format(self, record: LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'event', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return dumps(data, ensure_ascii=False)
+
+
+def tail(filename: str, length: int, block: int = 8192) -> list:
+    """Last lines of file, read by blocks from the end.
+
+    Args:
+        filename: file to read.
+        length: how many lines to read.
+        block (optional): size of read block.
+    """
+    if length <= 0 or not exists(filename):
+        return []
+    with open(filename, 'rb') as file:
+        position = file.seek(0, SEEK_END)
+        chunks = []
+        breaks = 0
+        # One more line break, than lines needed, or file beginning
+        while position > 0 and breaks <= length:
+            step = min(block, position)
+            position -= step
+            file.seek(position)
+            chunks.append(file.read(step))
+            breaks += chunks[-1].count(b'\n')
+    data = b''.join(reversed(chunks))
+    lines = data.decode(errors='replace').splitlines()
+    return lines[-length:]
+
+
+def tail_rotated(filename: str, length: int, backups: int) -> list:
+    """Last lines of log with rotated backups (filename.1, ...).
+
+    Args:
+        filename: current log file.
+        length: how many lines to read.
+        backups: how many backups log can have.
+    """
+    lines = []
+    for num in range(backups + 1):
+        name = filename if num == 0 else f'{filename}.{num}'
+        lines = tail(name, length - len(lines)) + lines
+        if len(lines) >= length:
+            break
+    return lines
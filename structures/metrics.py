@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+"""tuple: upper bounds of latency histogram buckets in seconds."""
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+    def __init__(self) -> None:
+        self.__buckets = [0] * (len(BUCKETS) + 1)
+        self.__count = 0
+        self.__sum = 0.0
+        self.__lock = Lock()
+
+    @property
+    def as_tuple(self) -> tuple:
+        """For getting bucket counts, count and sum of observations"""
+        with self.__lock:
+            return list(self.__buckets), self.__count, self.__sum
+
+    def observe(self, seconds: float) -> None:
+        index = len(BUCKETS)
+        for num, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                index = num
+                break
+        with self.__lock:
+            self.__buckets[index] += 1
+            self.__count += 1
+            self.__sum += seconds
+
+    def percentile(self, rank: float) -> float:
+        """Upper bound of bucket containing percentile.
+
+        Args:
+            rank: percentile from 0 to 1.
+        """
+        buckets, count, _ = self.as_tuple
+        seen = 0
+        for num, value in enumerate(buckets):
+            seen += value
+            if count and seen >= rank * count:
+                return BUCKETS[num] if num < len(BUCKETS) else float('inf')
+        return 0.0
+
+
+class Metrics:
+    """In-process counters, gauges and latency histograms.
+
+    Can be read as short text summary or in Prometheus text format,
+    optionally served by HTTP on local port.
+
+    Attributes:
+        prefix (optional): prefix of metric names in Prometheus format.
+    """
+    def __init__(self, prefix: str = 'parking_bot') -> None:
+        self.__prefix = prefix
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        self.__lock = Lock()
+
+    def inc(self, name: str, value: int = 1) -> None:
+        """Increment counter."""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def gauge(self, name: str, function) -> None:
+        """Register gauge.
+
+        Args:
+            name: gauge name.
+            function: callable without arguments returning value.
+        """
+        self.__gauges[name] = function
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Add observation to latency histogram."""
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Context manager observing time of its block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def wrap(self, name: str, function):
+        """Wrap function to observe time of its calls."""
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    @property
+    def summary(self) -> str:
+        """Short text summary for messages."""
+        lines = []
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(self.__histograms.items())
+        for name, value in counters:
+            lines.append(f'{name}: {value}')
+        for name, function in sorted(self.__gauges.items()):
+            lines.append(f'{name}: {function()}')
+        for name, histogram in histograms:
+            _, count, total = histogram.as_tuple
+            lines.append(
+                f'{name}: {count} шт, среднее {total / count * 1000:.1f} мс, '
+                f'p95 <= {histogram.percentile(0.95) * 1000:g} мс')
+        return '\n'.join(lines)
+
+    @property
+    def prometheus(self) -> str:
+        """Metrics in Prometheus text format."""
+        lines = []
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(self.__histograms.items())
+        for name, value in counters:
+            name = f'{self.__prefix}_{name}_total'
+            lines += [f'# TYPE {name} counter', f'{name} {value}']
+        for name, function in sorted(self.__gauges.items()):
+            name = f'{self.__prefix}_{name}'
+            lines += [f'# TYPE {name} gauge', f'{name} {function()}']
+        for name, histogram in histograms:
+            name = f'{self.__prefix}_{name}_seconds'
+            buckets, count, total = histogram.as_tuple
+            lines.append(f'# TYPE {name} histogram')
+            seen = 0
+            for bound, value in zip(BUCKETS + ('+Inf', ), buckets):
+                seen += value
+                lines.append(f'{name}_bucket{{le="{bound}"}} {seen}')
+            lines += [f'{name}_sum {total}', f'{name}_count {count}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> None:
+        """Serve Prometheus metrics by HTTP in background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.prometheus.encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=server.serve_forever, name='metrics',
+               daemon=True).start()
@@ -1,8 +1,38 @@
-from copy import deepcopy
+from collections import namedtuple
 from datetime import datetime
+from enum import IntEnum
+from threading import Lock
 
 from emoji import emojize
 
+PLACE_SIGNS = {
+    'free': emojize(':green_square:'),
+    'reserved': emojize(':yellow_square:'),
+    'occupied': emojize(':red_square:'),
+}
+"""dict: place sign for every state."""
+
+
+class PlaceState(IntEnum):
+    """Code of place state, `name.lower()` is state name."""
+    FREE = 0
+    RESERVED = 1
+    OCCUPIED = 2
+
+
+STATE_NAMES = tuple(state.name.lower() for state in PlaceState)
+"""tuple: state name by state code."""
+
+PlaceSnapshot = namedtuple('PlaceSnapshot',
+                           ('number', 'state', 'occupant', 'occupy_since'))
+PlaceSnapshot.__doc__ = """Immutable copy of place for statistics and
+notifications, has the same fields as `ParkingPlace.as_tuple`."""
+
+
+class StaleError(ValueError):
+    """Place changed since keyboard was made (or there is no such place
+    any more)."""
+
 
 class ParkingPlace:
     """Representation of parking place.
@@ -18,12 +48,36 @@ class ParkingPlace:
     and can toggle between them (free -> reserved -> occupied -> free).
     Since place reserved or occupied no other user can take this place.
     Also user can cancel reserve.
+
+    Version of place increments on every change. Place keeps time since
+    it is reserved or occupied.
+
+    Place has slots and keeps state as PlaceState code, `state` is still
+    state name, so it's small in memory and pickles.
     """
+    __slots__ = ('__number', '__code', '__occupant', '__occupy_since',
+                 '__version')
+
     def __init__(self, number: str) -> None:
         self.__number = number
-        self.__state = 'free'
+        self.__code = PlaceState.FREE
         self.__occupant = None
         self.__occupy_since = None
+        self.__version = 0
+
+    def __getstate__(self) -> tuple:
+        return self.as_tuple + (self.__version, )
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, tuple):
+            self.restore(state)
+            return
+        # Place pickled before slots has dict of mangled attributes
+        state = {key.replace('_ParkingPlace__', ''): value
+                 for key, value in state.items()}
+        self.as_tuple = (state['number'], state['state'], state['occupant'],
+                         state['occupy_since'])
+        self.__version = state.get('version', 0)
 
     @property
     def number(self) -> str:
@@ -31,7 +85,11 @@ class ParkingPlace:
 
     @property
     def state(self) -> str:
-        return self.__state
+        return STATE_NAMES[self.__code]
+
+    @property
+    def code(self) -> PlaceState:
+        return self.__code
 
     @property
     def occupant(self) -> str:
@@ -41,6 +99,35 @@ class ParkingPlace:
     def occupy_since(self) -> datetime:
         return self.__occupy_since
 
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def as_tuple(self) -> tuple:
+        """For getting place as tuple of number, state, occupant and
+        occupy since."""
+        return (self.__number, STATE_NAMES[self.__code], self.__occupant,
+                self.__occupy_since)
+
+    @as_tuple.setter
+    def as_tuple(self, place: tuple) -> None:
+        """For setting place from tuple"""
+        number, state, self.__occupant, self.__occupy_since = place
+        self.__number = number
+        self.__code = PlaceState(STATE_NAMES.index(state))
+
+    def restore(self, place: tuple) -> None:
+        """Set place from tuple of `as_tuple` fields and version."""
+        self.as_tuple = place[:4]
+        self.__version = place[4]
+
+    @property
+    def snapshot(self) -> PlaceSnapshot:
+        """Immutable copy of place."""
+        return PlaceSnapshot(self.__number, STATE_NAMES[self.__code],
+                             self.__occupant, self.__occupy_since)
+
     def toggle_state(self, user_id: str) -> None:
         """Toggles place state.
 
@@ -51,19 +138,21 @@ class ParkingPlace:
             ValueError: if user wants place that not free and
             don't belong to him.
         """
-        if self.__state == 'free':
-            self.__state = 'reserved'
+        if self.__code == PlaceState.FREE:
+            self.__code = PlaceState.RESERVED
             self.__occupant = user_id
+            self.__occupy_since = datetime.now()
         elif self.__occupant == user_id:
-            if self.__state == 'reserved':
-                self.__state = 'occupied'
+            if self.__code == PlaceState.RESERVED:
+                self.__code = PlaceState.OCCUPIED
                 self.__occupy_since = datetime.now()
-            elif self.__state == 'occupied':
-                self.__state = 'free'
+            elif self.__code == PlaceState.OCCUPIED:
+                self.__code = PlaceState.FREE
                 self.__occupant = None
                 self.__occupy_since = None
         else:
             raise ValueError
+        self.__version += 1
 
     def cancel_reserve(self, user: str) -> None:
         """Cancel the reserve and change place state to free.
@@ -75,50 +164,160 @@ class ParkingPlace:
             ValueError: if place don't belong to user (it means that
             user press button on old keyboard).
         """
-        if self.__occupant == user and self.state == 'reserved':
-            self.__state = 'free'
+        if self.__occupant == user and self.__code == PlaceState.RESERVED:
+            self.__code = PlaceState.FREE
             self.__occupant = None
+            self.__occupy_since = None
+            self.__version += 1
         else:
             raise ValueError
 
     def clear(self) -> None:
         """For "clearing" the place without rights check."""
-        self.__state = 'free'
+        self.__code = PlaceState.FREE
         self.__occupant = None
         self.__occupy_since = None
+        self.__version += 1
 
 
 class Parking():
     """Representation of the parking lot.
 
+    Keeps index of places by number and counters of places by state,
+    so lookups and state summaries don't scan the whole lot. Places
+    should be changed through parking methods to keep them in sync.
+
+    Every place has own lock and changes can be made only for version
+    of place user have seen, so presses on different places don't wait
+    for each other and stale presses are rejected.
+
     Can be cleared (all places set to free without rights check).
     """
     def __init__(self, numbers: list) -> None:
         self.__places = self.__populate_parking(numbers)
+        self.__reindex()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_Parking__locks'], state['_Parking__lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        # Parking pickled before index existed has only places
+        self.__dict__.update(state)
+        self.__reindex()
 
     @property
     def places(self) -> list:
         return self.__places
 
+    @property
+    def version(self) -> int:
+        """Increments on every state change."""
+        return self.__version
+
+    @property
+    def as_list(self) -> list:
+        """For getting places as list of tuples"""
+        return [place.as_tuple for place in self.__places]
+
+    @as_list.setter
+    def as_list(self, places: list) -> None:
+        """For setting places from list of tuples"""
+        self.__places = []
+        for place in places:
+            self.__places.append(ParkingPlace(place[0]))
+            self.__places[-1].as_tuple = place
+        self.__reindex()
+
+    @property
+    def counters(self) -> dict:
+        """Number of places in each state."""
+        return dict(self.__counters)
+
     @property
     def state(self) -> list:
         """For keyboard making.
 
         Returns:
-            list: list of tuples for place representation while
-            making keyboard.
+            list: list of tuples of sign, state, number, occupant and
+            version for place representation while making keyboard.
         """
-        return self.__make_state()
+        version = self.__version
+        if self.__state is None or self.__state[0] != version:
+            self.__state = (version, self.__make_state())
+        return self.__state[1]
 
     @property
     def state_text(self) -> str:
         """Text state for "status" message"""
-        return self.__make_state_text()
+        version = self.__version
+        if self.__state_text is None or self.__state_text[0] != version:
+            self.__state_text = (version, self.__make_state_text())
+        return self.__state_text[1]
+
+    @property
+    def state_summary(self) -> str:
+        """Short "status" text with number of places in each state, for
+        lots too big for sign per place."""
+        counters = self.counters
+        return ' '.join(f'{PLACE_SIGNS[state]} {counters[state]}'
+                        for state in ('occupied', 'reserved', 'free'))
 
     @property
     def is_free(self) -> bool:
         """Is parking free."""
-        return self.__check_free()
+        return self.__counters['free'] == len(self.__places)
+
+    def place(self, number: str) -> ParkingPlace:
+        """Place by number.
+
+        Raises:
+            StaleError: if there is no such place (it means that
+            user press button on old keyboard).
+        """
+        try:
+            return self.__index[number]
+        except KeyError:
+            raise StaleError
+
+    def toggle_state(self, number: str, user_id: str,
+                     version: int = None) -> tuple:
+        """Toggles state of place, see `ParkingPlace.toggle_state`.
+
+        Args:
+            number: place number.
+            user_id: user that toggles place.
+            version (optional): place version user have seen.
+
+        Raises:
+            StaleError: if place version is not the same.
+            ValueError: if place is not free and don't belong to user.
+
+        Returns:
+            tuple: snapshots of place before and after change.
+        """
+        return self.__change(number, version, ParkingPlace.toggle_state,
+                             user_id)
+
+    def cancel_reserve(self, number: str, user: str,
+                       version: int = None) -> tuple:
+        """Cancels reserve of place, see `ParkingPlace.cancel_reserve`.
+
+        Args:
+            number: place number.
+            user: user that cancels reserve.
+            version (optional): place version user have seen.
+
+        Raises:
+            StaleError: if place version is not the same.
+            ValueError: if reserve don't belong to user.
+
+        Returns:
+            tuple: snapshots of place before and after change.
+        """
+        return self.__change(number, version, ParkingPlace.cancel_reserve,
+                             user)
 
     def clear(self) -> list:
         """Free all places of parking.
@@ -128,54 +327,135 @@ class Parking():
             user press button on old keyboard).
 
         Returns:
-            list: copy of places that have been cleared for statistics count.
+            list: snapshots of places that have been cleared for
+            statistics count.
         """
         places = []
-        if not self.is_free:
+        locks = [self.__locks[place.number] for place in self.__places]
+        for lock in locks:
+            lock.acquire()
+        try:
+            if self.is_free:
+                raise ValueError
             for place in self.__places:
-                if place.state != 'free':
-                    places.append(deepcopy(place))
+                if place.code != PlaceState.FREE:
+                    places.append(place.snapshot)
+                    state = place.state
                     place.clear()
-        else:
-            raise ValueError
+                    self.__changed(state, 'free')
+        finally:
+            for lock in locks:
+                lock.release()
         return places
 
+    def reconcile(self, numbers: list) -> list:
+        """Change places of parking to numbers, keeping state of places
+        which are still there.
+
+        Kept places keep their versions, so keyboards made before are
+        still valid for them, new places are free.
+
+        Args:
+            numbers: new place numbers in order.
+
+        Returns:
+            list: snapshots of removed places.
+        """
+        numbers = [str(number) for number in numbers]
+        locks = [self.__locks[place.number] for place in self.__places]
+        for lock in locks:
+            lock.acquire()
+        try:
+            kept = set(numbers)
+            retired = [place.snapshot for place in self.__places
+                       if place.number not in kept]
+            self.__places = [self.__index.get(number) or ParkingPlace(number)
+                             for number in numbers]
+            self.__index = {place.number: place for place in self.__places}
+            # Locks of kept places may be awaited, so they are the same
+            self.__locks = {number: self.__locks.get(number) or Lock()
+                            for number in numbers}
+            with self.__lock:
+                self.__recount()
+                self.__version += 1
+        finally:
+            for lock in locks:
+                lock.release()
+        return retired
+
+    def restore(self, places: list) -> None:
+        """Set places with their versions, changed by other process.
+
+        Args:
+            places: tuples of `ParkingPlace.as_tuple` fields and version,
+            places not in list are removed.
+        """
+        if [place.number for place in self.__places] != [
+                place[0] for place in places]:
+            self.reconcile([place[0] for place in places])
+        locks = [self.__locks[place.number] for place in self.__places]
+        for lock in locks:
+            lock.acquire()
+        try:
+            for place in places:
+                self.__index[place[0]].restore(place)
+            with self.__lock:
+                self.__recount()
+                self.__version += 1
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def __change(self, number: str, version: int, change, *args) -> tuple:
+        place = self.place(number)
+        lock = self.__locks.get(number)
+        if lock is None:
+            raise StaleError
+        with lock:
+            # Place could be removed by reconcile while lock was awaited
+            if self.__index.get(number) is not place:
+                raise StaleError
+            if version is not None and version != place.version:
+                raise StaleError
+            old = place.snapshot
+            change(place, *args)
+            self.__changed(old.state, place.state)
+            return old, place.snapshot
+
     def __populate_parking(self, numbers: list) -> list:
         places = []
         for number in numbers:
             places.append(ParkingPlace(str(number)))
         return places
 
-    def __check_free(self) -> bool:
-        free = True
+    def __reindex(self) -> None:
+        self.__index = {place.number: place for place in self.__places}
+        self.__locks = {place.number: Lock() for place in self.__places}
+        self.__lock = Lock()
+        self.__version = 0
+        self.__recount()
+
+    def __recount(self) -> None:
+        self.__counters = dict.fromkeys(PLACE_SIGNS, 0)
         for place in self.__places:
-            if place.state != 'free':
-                free = False
-                break
-        return free
+            self.__counters[place.state] += 1
+        self.__state = None
+        self.__state_text = None
+
+    def __changed(self, old: str, new: str) -> None:
+        with self.__lock:
+            self.__counters[old] -= 1
+            self.__counters[new] += 1
+            self.__version += 1
 
     def __make_state(self) -> list:
         state = []
         for place in self.__places:
-            place_sign = self.__make_place_sign(place)
-            state.append((place_sign, place.state,
-                         place.number, place.occupant))
+            place_sign = PLACE_SIGNS[place.state]
+            state.append((place_sign, place.state, place.number,
+                          place.occupant, place.version))
         return state
 
     def __make_state_text(self) -> str:
-        sort_order = {'occupied': 0, 'reserved': 1, 'free': 2}
-        places = sorted(self.__places, key=lambda x: sort_order[x.state])
-        state_text = ''
-        for place in places:
-            place_sign = self.__make_place_sign(place)
-            state_text = ''.join([state_text, place_sign])
-        return state_text
-
-    def __make_place_sign(self, place: ParkingPlace) -> str:
-        if place.state == 'free':
-            place_sign = emojize(':green_square:')
-        elif place.state == 'reserved':
-            place_sign = emojize(':yellow_square:')
-        elif place.state == 'occupied':
-            place_sign = emojize(':red_square:')
-        return place_sign
+        return ''.join(PLACE_SIGNS[state] * self.__counters[state]
+                       for state in ('occupied', 'reserved', 'free'))
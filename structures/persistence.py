@@ -0,0 +1,343 @@
+from collections import defaultdict
+from datetime import datetime
+from os.path import exists, getsize
+from pickle import HIGHEST_PROTOCOL, dumps, load, loads
+from sqlite3 import connect
+from threading import Lock
+
+from telegram.ext import BasePersistence
+
+from .metrics import Metrics
+from .parking import Parking
+from .stats import Stats
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS places (
+    lot TEXT NOT NULL DEFAULT '',
+    number TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    occupant TEXT,
+    since REAL,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (lot, number)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    lot TEXT NOT NULL DEFAULT '',
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value NOT NULL,
+    PRIMARY KEY (lot, dimension, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    user TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    text INTEGER NOT NULL,
+    markup INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS data (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+'''
+
+DIMENSIONS = ('users', 'places', 'persons', 'weekdays', 'monthes')
+"""tuple: statistics dimensions stored by key."""
+
+HEADER = b'SQLite format 3\x00'
+"""bytes: start of every SQLite database file."""
+
+
+def check_database(filename: str) -> None:
+    """Check that data file is SQLite database or doesn't exist yet.
+
+    Raises:
+        ValueError: if file has other format, like pickle data file of
+        older bot.
+    """
+    if not exists(filename) or getsize(filename) == 0:
+        return
+    with open(filename, 'rb') as file:
+        if file.read(len(HEADER)) != HEADER:
+            raise ValueError(
+                f'Data file "{filename}" is not SQLite database, move it to '
+                'legacy_data_file option and set data_file to new file '
+                '(like "data.sqlite3") to import it')
+
+
+class SQLitePersistence(BasePersistence):
+    """Incremental persistence of bot data in SQLite.
+
+    Parking places and statistics of every lot and status messages are
+    stored as rows and only changed rows are written after every
+    update. Other bot data keys are pickled one by one. Database is in
+    WAL mode, so every write is a small crash safe transaction.
+
+    Bot data "parking" and "stats" are dicts by lot name, data of
+    older bot with single parking goes to lot "".
+
+    Only bot data is stored, user and chat data are not used by bot.
+
+    Attributes:
+        filename: SQLite database file.
+        legacy_file (optional): PicklePersistence file to import data
+        from, if database is empty.
+        metrics (optional): for timing of writes.
+    """
+    def __init__(self, filename: str, legacy_file: str = None,
+                 metrics: Metrics = None) -> None:
+        super().__init__(store_user_data=False, store_chat_data=False,
+                         store_bot_data=True)
+        self.__connection = connect(filename, check_same_thread=False)
+        self.__lock = Lock()
+        self.__legacy_file = legacy_file
+        self.__metrics = metrics or Metrics()
+        self.__written = {'places': {}, 'stats': {}, 'messages': {},
+                          'data': {}}
+        self.__versions = {}
+        with self.__lock, self.__connection:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.executescript(SCHEMA)
+
+    def replace_bot(self, obj: object) -> object:
+        # Bot data has no bots inside, so don't copy it on every update
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    def get_bot_data(self) -> dict:
+        with self.__lock:
+            bot_data = self.__load()
+        if not bot_data and self.__legacy_file and exists(
+                self.__legacy_file):
+            with open(self.__legacy_file, 'rb') as file:
+                bot_data = load(file).get('bot_data', {})
+            for key in ('parking', 'stats'):
+                if key in bot_data:
+                    bot_data[key] = {'': bot_data[key]}
+            self.update_bot_data(bot_data)
+        return bot_data
+
+    def update_bot_data(self, data: dict) -> None:
+        """Write rows changed since last update."""
+        with self.__metrics.timer('persistence_update'), self.__lock, \
+                self.__connection:
+            for key, value in list(data.items()):
+                if key == 'parking':
+                    self.__write_parking(value)
+                elif key == 'stats':
+                    self.__write_stats(value)
+                elif key == 'messages':
+                    self.__write_messages(value)
+                else:
+                    self.__write_data(key, value)
+
+    def load_stats(self) -> dict:
+        """Statistics dicts by lot as they are written now.
+
+        Several bot processes can share database, so process becoming
+        the one counting statistics takes them from database.
+        """
+        with self.__lock:
+            self.__versions = {key: version for key, version
+                               in self.__versions.items()
+                               if key[0] != 'stats'}
+            return self.__load_stats()
+
+    def load_data(self, key: str) -> object:
+        """Other bot data key as it's written now, None if there is none,
+        see `load_stats`."""
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT value FROM data WHERE key = ?', (key, )).fetchone()
+            if row is None:
+                self.__written['data'].pop(key, None)
+                return None
+            self.__written['data'][key] = row[0]
+            return loads(row[0])
+
+    def get_user_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def update_conversation(self, name: str, key: tuple,
+                            new_state: object) -> None:
+        pass
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        # Every update is already written
+        pass
+
+    def __load(self) -> dict:
+        bot_data = {}
+        lots = {}
+        for row in self.__connection.execute(
+                'SELECT lot, number, position, state, occupant, since, '
+                'version FROM places ORDER BY lot, position'):
+            lots.setdefault(row[0], []).append(row)
+        if lots:
+            bot_data['parking'] = {}
+        for lot, rows in lots.items():
+            places = [(number, state, occupant,
+                       datetime.fromtimestamp(since) if since else None,
+                       version)
+                      for _, number, _, state, occupant, since, version
+                      in rows]
+            parking = Parking([])
+            parking.as_list = [place[:4] for place in places]
+            # Keyboards made before restart stay stale by kept versions
+            for place in places:
+                parking.place(place[0]).restore(place)
+            bot_data['parking'][lot] = parking
+            self.__written['places'][lot] = {
+                (lot, row[1]): tuple(row) for row in rows}
+        lots = self.__load_stats()
+        if lots:
+            bot_data['stats'] = {}
+        for lot, stats_dict in lots.items():
+            bot_data['stats'][lot] = Stats({})
+            bot_data['stats'][lot].as_dict = stats_dict
+        rows = self.__connection.execute(
+            'SELECT user, id, text, markup FROM messages').fetchall()
+        if rows:
+            bot_data['messages'] = {}
+            for user, message_id, text, markup in rows:
+                bot_data['messages'][user] = {
+                    'id': message_id, 'text': text, 'markup': markup}
+                self.__written['messages'][(user, )] = (
+                    user, message_id, text, markup)
+        for key, value in self.__connection.execute(
+                'SELECT key, value FROM data'):
+            bot_data[key] = loads(value)
+            self.__written['data'][key] = value
+        return bot_data
+
+    def __load_stats(self) -> dict:
+        lots = {}
+        self.__written['stats'] = {}
+        for lot, dimension, key, value in self.__connection.execute(
+                'SELECT lot, dimension, key, value FROM stats'):
+            stats = lots.get(lot)
+            if stats is None:
+                stats = lots[lot] = dict.fromkeys(DIMENSIONS)
+                for name in DIMENSIONS:
+                    stats[name] = {}
+                stats['total_time'] = 0.0
+            if dimension == 'total_time':
+                stats['total_time'] = value
+            else:
+                stats[dimension][key] = value
+            self.__written['stats'].setdefault(lot, {})[
+                (lot, dimension, key)] = value
+        return lots
+
+    def __changed(self, key: tuple, obj: object) -> bool:
+        """Check version of versioned object since last write."""
+        version = (id(obj), obj.version)
+        if self.__versions.get(key) == version:
+            return False
+        self.__versions[key] = version
+        return True
+
+    def __write_parking(self, parkings: dict) -> None:
+        written = self.__written['places']
+        for lot in written.keys() - parkings.keys():
+            self.__connection.execute('DELETE FROM places WHERE lot = ?',
+                                      (lot, ))
+            del written[lot]
+            self.__versions.pop(('parking', lot), None)
+        for lot, parking in list(parkings.items()):
+            if not self.__changed(('parking', lot), parking):
+                continue
+            rows = {}
+            for position, place in enumerate(parking.places):
+                number, state, occupant, since = place.as_tuple
+                rows[(lot, number)] = (lot, number, position, state, occupant,
+                                       since.timestamp() if since else None,
+                                       place.version)
+            written[lot] = self.__write_rows(
+                'places', ('lot', 'number'), rows, written.get(lot, {}),
+                'INSERT OR REPLACE INTO places '
+                '(lot, number, position, state, occupant, since, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)')
+
+    def __write_stats(self, all_stats: dict) -> None:
+        written = self.__written['stats']
+        for lot in written.keys() - all_stats.keys():
+            self.__connection.execute('DELETE FROM stats WHERE lot = ?',
+                                      (lot, ))
+            del written[lot]
+            self.__versions.pop(('stats', lot), None)
+        for lot, stats in list(all_stats.items()):
+            if not self.__changed(('stats', lot), stats):
+                continue
+            rows = {}
+            stats_dict = stats.as_dict
+            for dimension in DIMENSIONS:
+                for key, value in list(stats_dict[dimension].items()):
+                    rows[(lot, dimension, key)] = value
+            rows[(lot, 'total_time', '')] = stats_dict['total_time']
+            old = written.get(lot, {})
+            for row in old.keys() - rows.keys():
+                self.__connection.execute(
+                    'DELETE FROM stats '
+                    'WHERE lot = ? AND dimension = ? AND key = ?', row)
+            for row, value in rows.items():
+                if old.get(row) != value:
+                    self.__connection.execute(
+                        'INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)',
+                        row + (value, ))
+            written[lot] = rows
+
+    def __write_messages(self, messages: dict) -> None:
+        rows = {}
+        for user, message in list(messages.items()):
+            rows[(user, )] = (user, message['id'], message['text'],
+                              message['markup'])
+        self.__written['messages'] = self.__write_rows(
+            'messages', ('user', ), rows, self.__written['messages'],
+            'INSERT OR REPLACE INTO messages '
+            '(user, id, text, markup) VALUES (?, ?, ?, ?)')
+
+    def __write_data(self, key: str, value: object) -> None:
+        value = dumps(value, HIGHEST_PROTOCOL)
+        if self.__written['data'].get(key) != value:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO data VALUES (?, ?)', (key, value))
+            self.__written['data'][key] = value
+
+    def __write_rows(self, table: str, keys: tuple, rows: dict,
+                     written: dict, query: str) -> dict:
+        """Write rows changed since written ones.
+
+        Args:
+            table: table name.
+            keys: key columns, rows are stored by tuples of their values.
+            rows: current rows.
+            written: rows from last write.
+            query: query for inserting or replacing row.
+
+        Returns:
+            dict: rows to compare next write with.
+        """
+        condition = ' AND '.join(f'{key} = ?' for key in keys)
+        for row in written.keys() - rows.keys():
+            self.__connection.execute(
+                f'DELETE FROM {table} WHERE {condition}', row)
+        for row, values in rows.items():
+            if written.get(row) != values:
+                self.__connection.execute(query, values)
+        return rows
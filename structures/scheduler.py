@@ -0,0 +1,112 @@
+from datetime import datetime
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from threading import Condition, Thread
+from time import time
+
+logger = getLogger(__name__)
+
+REMOVED = object()
+"""object: key of replaced or canceled timer left in heap."""
+
+
+class Scheduler:
+    """Timers on one thread with heap of deadlines.
+
+    There is at most one pending timer for every key, scheduling timer
+    with the same key replaces it. Timers due within `window` seconds
+    are passed to callback together (some of them a bit early), so
+    their changes can be broadcast at once.
+
+    Attributes:
+        callback: called in scheduler thread with list of (key, payload)
+        tuples of due timers.
+        window (optional): seconds to batch timers for.
+    """
+    def __init__(self, callback, window: float = 1.0) -> None:
+        self.__callback = callback
+        self.__window = window
+        self.__heap = []
+        self.__timers = {}
+        self.__order = count()
+        self.__condition = Condition()
+        self.__thread = None
+        self.__running = False
+
+    def __len__(self) -> int:
+        return len(self.__timers)
+
+    @property
+    def window(self) -> float:
+        return self.__window
+
+    def schedule(self, key, when: datetime, payload=None) -> None:
+        """Set timer for key, replacing pending one.
+
+        Args:
+            key: hashable timer key.
+            when: time timer is due.
+            payload (optional): passed to callback with key.
+        """
+        entry = [when.timestamp(), next(self.__order), key, payload]
+        with self.__condition:
+            self.__remove(key)
+            self.__timers[key] = entry
+            heappush(self.__heap, entry)
+            self.__condition.notify()
+
+    def cancel(self, key) -> bool:
+        """Cancel pending timer, returns if there was one."""
+        with self.__condition:
+            return self.__remove(key)
+
+    def start(self) -> None:
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name='scheduler',
+                               daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """Stop scheduler, pending timers are dropped."""
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __remove(self, key) -> bool:
+        entry = self.__timers.pop(key, None)
+        if entry is None:
+            return False
+        # Heap entry is dropped when it gets to the top
+        entry[2] = REMOVED
+        return True
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while self.__running:
+                    while self.__heap and self.__heap[0][2] is REMOVED:
+                        heappop(self.__heap)
+                    if not self.__heap:
+                        self.__condition.wait()
+                        continue
+                    delay = self.__heap[0][0] - time()
+                    if delay <= 0:
+                        break
+                    self.__condition.wait(delay)
+                if not self.__running:
+                    return
+                due = []
+                now = time() + self.__window
+                while self.__heap and self.__heap[0][0] <= now:
+                    _, _, key, payload = heappop(self.__heap)
+                    if key is not REMOVED:
+                        del self.__timers[key]
+                        due.append((key, payload))
+            try:
+                self.__callback(due)
+            except Exception:
+                logger.exception('Ошибка таймеров')
@@ -1,9 +1,22 @@
 from copy import deepcopy
 from datetime import date, datetime, timedelta
+from threading import RLock
 
 from emoji import emojize
 
-from .parking import ParkingPlace
+from .events import EventLog
+from .parking import PlaceSnapshot
+
+SIGNS = {
+    'header': emojize(':bar_chart:'),
+    'count': emojize(':abacus:'),
+    'time': emojize(':stopwatch:'),
+    'places': emojize(':P_button:'),
+    'persons': emojize(':bust_in_silhouette:'),
+    'weekdays': emojize(':tear-off_calendar:'),
+    'monthes': emojize(':spiral_calendar:'),
+}
+"""dict: signs of statistics message sections."""
 
 
 class Stats:
@@ -13,6 +26,15 @@ class Stats:
     we keep all original ones for captions.
 
     Have multiple dimensions, like weekdays, persons, etc...
+    Rankings of dimensions are kept sorted while counting and message
+    text is rendered only after statistics change.
+
+    Stats can be changed from several threads, changes are made under
+    lock.
+
+    Lifetime counters live in stats itself (they include history from
+    before event log), statistics for periods are views over attached
+    event log.
     """
     def __init__(self, users: dict) -> None:
         self.__users = deepcopy(users)
@@ -21,11 +43,43 @@ class Stats:
         self.__weekdays = {}
         self.__monthes = {}
         self.__total_time = 0.0
+        self.__version = 0
+        self.__log = None
+        self.__lock = RLock()
+        self.__rerank()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_Stats__log'] = None
+        state.pop('_Stats__lock', None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        # Stats pickled before rankings existed have only counters
+        self.__dict__.update(state)
+        self.__version = state.get('_Stats__version', 0)
+        self.__log = None
+        self.__lock = RLock()
+        self.__rerank()
+
+    @property
+    def version(self) -> int:
+        """Increments on every statistics change."""
+        return self.__version
+
+    @property
+    def log(self) -> EventLog:
+        return self.__log
 
     @property
     def message_text(self):
         """Contains statistics text for messages"""
-        return self.__make_message_text()
+        with self.__lock:
+            if self.__text is None or self.__text[0] != self.__version:
+                self.__text = (self.__version, self.__make_message_text(
+                    '*Статистика*', self.__make(),
+                    sum(self.__places.values()), self.__total_time))
+            return self.__text[1]
 
     @property
     def as_dict(self) -> dict:
@@ -42,36 +96,103 @@ class Stats:
     @as_dict.setter
     def as_dict(self, stats) -> None:
         """For setting statistics from dict"""
-        self.__users = stats['users']
-        self.__places = stats['places']
-        self.__persons = stats['persons']
-        self.__weekdays = stats['weekdays']
-        self.__monthes = stats['monthes']
-        self.__total_time = stats['total_time']
-
-    def count(self, place: ParkingPlace) -> None:
+        with self.__lock:
+            self.__users = stats['users']
+            self.__places = stats['places']
+            self.__persons = stats['persons']
+            self.__weekdays = stats['weekdays']
+            self.__monthes = stats['monthes']
+            self.__total_time = stats['total_time']
+            self.__rerank()
+            self.__changed()
+
+    def count(self, place: PlaceSnapshot, user: str = None) -> None:
         """Count place in statistics.
 
-        For reserved places it means that place have been just occupied.
-        For occupied - just freed.
+        For free places it means that place have been just reserved.
+        For reserved places - just occupied. For occupied - just freed.
+
+        Args:
+            place (PlaceSnapshot): place that needs to be counted.
+            Should be BEFORE state change.
+            user (optional): user that reserved free place, it has no
+            occupant before change.
+        """
+        with self.__lock:
+            today = date.today()
+            if place.state == 'free':
+                self.__append('reserve', place._replace(occupant=user))
+            elif place.state == 'reserved':
+                self.__bump('places', place.number)
+                self.__bump('persons', place.occupant)
+                self.__bump('weekdays', today.strftime('%A'))
+                self.__bump('monthes', today.strftime('%B'))
+                self.__append('occupy', place)
+                self.__changed()
+            elif place.state == 'occupied':
+                duration = (
+                    datetime.today() - place.occupy_since).total_seconds()
+                self.__total_time = self.__total_time + duration
+                self.__append('free', place, duration)
+                self.__changed()
+
+    def cancel(self, place: PlaceSnapshot) -> None:
+        """Log reserve cancel, it's not counted in statistics.
 
         Args:
-            place (ParkingPlace): place that needs to be counted.
+            place (PlaceSnapshot): place that reserve is canceled.
             Should be BEFORE state change.
         """
-        today = date.today()
-        if place.state == 'reserved':
-            self.__places[place.number] = self.__places.get(
-                place.number, 0) + 1
-            self.__persons[place.occupant] = self.__persons.get(
-                place.occupant, 0) + 1
-            self.__weekdays[today.strftime('%A')] = self.__weekdays.get(
-                today.strftime('%A'), 0) + 1
-            self.__monthes[today.strftime('%B')] = self.__monthes.get(
-                today.strftime('%B'), 0) + 1
-        elif place.state == 'occupied':
-            self.__total_time = self.__total_time + (
-                datetime.today() - place.occupy_since).total_seconds()
+        self.__append('cancel', place)
+
+    def attach(self, log: EventLog) -> None:
+        """Attach event log for writing events and period statistics.
+
+        Event log is not pickled with stats, so it should be attached
+        after every load.
+        """
+        self.__log = log
+
+    def period_text(self, since: date, until: date = None) -> str:
+        """Statistics text for period from event log.
+
+        Args:
+            since: first day of period.
+            until (optional): last day of period, defaults to today.
+
+        Raises:
+            ValueError: if there is no event log attached.
+        """
+        if self.__log is None:
+            raise ValueError
+        until = until or date.today()
+        totals = self.__log.totals(since, until)
+        monthes = {datetime.strptime(month, '%Y-%m').strftime('%B %Y'): value
+                   for month, value in totals['monthes'].items()}
+        rankings = tuple(
+            self.__rank(counter) for counter in (
+                totals['places'], totals['persons'], totals['weekdays'],
+                monthes))
+        period = '–'.join(day.strftime('%d.%m.%Y') for day in (since, until))
+        return self.__make_message_text(
+            '*Статистика* ' + period.replace('.', r'\.'), rankings,
+            sum(totals['places'].values()), totals['total_time'])
+
+    def merge(self, stats: dict) -> None:
+        """Add counters to statistics.
+
+        Args:
+            stats: dict like `as_dict`, counters are added to current
+            ones, users are added or renamed. Any key can be omitted.
+        """
+        with self.__lock:
+            self.__users.update(stats.get('users', {}))
+            for name, counter in self.__counters().items():
+                for item, value in stats.get(name, {}).items():
+                    counter[item] = counter.get(item, 0) + value
+            self.__total_time += stats.get('total_time', 0.0)
+            self.__rerank()
+            self.__changed()
 
     def update_users(self, users: dict) -> None:
         """For adding users while bot is already running.
@@ -79,53 +200,85 @@ class Stats:
         We only add users, removed ones stays for history.
 
         Args:
-            users: new users.
+            users: new or renamed users.
         """
-        # Adding new users
-        new_users = set(users) - set(self.__users)
-        if new_users != set():
-            for user in new_users:
-                self.__users[user] = users[user]
-        # If user changes name - we should change it too
-        for user in users:
-            if self.__users[user] != users[user]:
-                self.__users[user] = users[user]
+        with self.__lock:
+            for user in users:
+                if self.__users.get(user) != users[user]:
+                    self.__users[user] = users[user]
+                    self.__changed()
+
+    def __counters(self) -> dict:
+        return {'places': self.__places, 'persons': self.__persons,
+                'weekdays': self.__weekdays, 'monthes': self.__monthes}
+
+    def __rerank(self) -> None:
+        self.__rankings = {}
+        self.__positions = {}
+        for name, counter in self.__counters().items():
+            ranking = [item for item, _ in self.__rank(counter)]
+            self.__rankings[name] = ranking
+            self.__positions[name] = {
+                item: num for num, item in enumerate(ranking)}
+        self.__text = None
+
+    def __bump(self, name: str, item: str) -> None:
+        """Increments item counter and moves it up in ranking."""
+        counter = self.__counters()[name]
+        ranking = self.__rankings[name]
+        positions = self.__positions[name]
+        counter[item] = counter.get(item, 0) + 1
+        if item not in positions:
+            positions[item] = len(ranking)
+            ranking.append(item)
+        index = positions[item]
+        while index > 0 and counter[ranking[index - 1]] < counter[item]:
+            ranking[index] = ranking[index - 1]
+            positions[ranking[index]] = index
+            index -= 1
+        ranking[index] = item
+        positions[item] = index
+
+    def __append(self, action: str, place: PlaceSnapshot,
+                 duration: float = 0.0) -> None:
+        if self.__log is not None:
+            self.__log.append(action, place.number, place.occupant, duration)
+
+    def __changed(self) -> None:
+        self.__version += 1
 
     def __make(self) -> tuple:
-        return (self.__rank(self.__places), self.__rank(self.__persons),
-                self.__rank(self.__weekdays), self.__rank(self.__monthes))
+        return tuple(
+            [(item, counter[item]) for item in self.__rankings[name]]
+            for name, counter in self.__counters().items())
 
     def __rank(self, slice: dict) -> list:
         return sorted(slice.items(), key=lambda tup: tup[1], reverse=True)
 
-    def __make_message_text(self) -> str:
-        places, persons, weekdays, monthes = self.__make()
-        total_count = sum(self.__places.values())
-        total_time = ':'.join(
-            str(timedelta(0, self.__total_time)).split(':')[:2])
+    def __make_message_text(self, title: str, rankings: tuple,
+                            total_count: int, total_time: float) -> str:
+        places, persons, weekdays, monthes = rankings
+        total_time = ':'.join(str(timedelta(0, total_time)).split(':')[:2])
         places = self.__make_message_text_block(places)
         persons = self.__make_message_text_block(persons, self.__users)
         weekdays = self.__make_message_text_block(weekdays)
         monthes = self.__make_message_text_block(monthes)
         return '\n\n'.join(
-            [' '.join([emojize(':bar_chart:'), f'*Статистика*']),
-             ' '.join([emojize(':abacus:'),
-                      fr'*Суммарное кол\-во*: {total_count}']) + '\n' +
-             ' '.join([emojize(':stopwatch:'),
-                      f'*Суммарное время*: {total_time}']),
-             ' '.join([emojize(':P_button:'), f'*Места*{places}']),
-             ' '.join([emojize(':bust_in_silhouette:'), f'*Люди*{persons}']),
-             ' '.join([emojize(':tear-off_calendar:'),
-                      f'*Дни недели*{weekdays}']),
-             ' '.join([emojize(':spiral_calendar:'), f'*Месяцы*{monthes}'])])
+            [SIGNS['header'] + ' ' + title,
+             SIGNS['count'] + fr' *Суммарное кол\-во*: {total_count}' + '\n' +
+             SIGNS['time'] + f' *Суммарное время*: {total_time}',
+             SIGNS['places'] + f' *Места*{places}',
+             SIGNS['persons'] + f' *Люди*{persons}',
+             SIGNS['weekdays'] + f' *Дни недели*{weekdays}',
+             SIGNS['monthes'] + f' *Месяцы*{monthes}'])
 
     def __make_message_text_block(self, block: list, users=None) -> str:
-        text = ''
+        lines = ['']
         for num, entry in enumerate(block, start=1):
             item, value = entry
             if users is not None:
                 # We need names, not id's
-                item = self.__users[item]
-            text = '\n'.join([text, ' '.join([str(num) +
-                             r'\.', str(item), r'\- ' + str(value)])])
-        return text
+                item = self.__users.get(item, item)
+            lines.append(' '.join([str(num) + r'\.', str(item),
+                                   r'\- ' + str(value)]))
+        return '\n'.join(lines)
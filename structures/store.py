@@ -0,0 +1,320 @@
+from datetime import datetime
+from json import dumps, loads
+from sqlite3 import connect
+from threading import Lock
+from time import time
+
+from .parking import PlaceSnapshot
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shared_places (
+    lot TEXT NOT NULL,
+    number TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    occupant TEXT,
+    since REAL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (lot, number)
+);
+CREATE TABLE IF NOT EXISTS shared_users (
+    user TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    blocked INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS shared_subscribers (
+    user TEXT PRIMARY KEY,
+    lot TEXT NOT NULL,
+    mode TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shared_versions (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shared_published (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lot TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+'''
+
+BUMP = ('INSERT INTO shared_versions VALUES (?, 1) ON CONFLICT (key) '
+        'DO UPDATE SET version = version + 1')
+"""str: query incrementing version of shared data key."""
+
+
+class SharedStore:
+    """State shared by bot processes in SQLite file.
+
+    Places, users and subscribers are written through by process
+    changing them, every write increments version of its key ("users",
+    "subscribers" or "lot:NAME"), so other processes reload only changed
+    data. Places are changed optimistically: change is written only if
+    place still has version process have seen.
+
+    Changes are appended to outbox, which is read by one process holding
+    leader lease, so statistics are counted and notifications are sent
+    once. SQLite file locks serialize writes of processes.
+
+    Attributes:
+        filename: SQLite database file, can be the same as data file.
+        owner: name of process for leader lease.
+    """
+    def __init__(self, filename: str, owner: str) -> None:
+        self.__owner = owner
+        self.__connection = connect(filename, timeout=10,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.__lock = Lock()
+        with self.__lock:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.executescript(SCHEMA)
+
+    @property
+    def owner(self) -> str:
+        return self.__owner
+
+    def versions(self) -> dict:
+        """Versions of shared data by key."""
+        with self.__lock:
+            return dict(self.__connection.execute(
+                'SELECT key, version FROM shared_versions'))
+
+    def places(self, lot: str) -> list:
+        """Places of lot as tuples of number, state, occupant, occupy
+        since and version, empty if lot is not shared yet."""
+        with self.__lock:
+            rows = self.__connection.execute(
+                'SELECT number, state, occupant, since, version '
+                'FROM shared_places WHERE lot = ? ORDER BY position', (lot, ))
+            return [(number, state, occupant,
+                     datetime.fromtimestamp(since) if since else None,
+                     version)
+                    for number, state, occupant, since, version in rows]
+
+    def save_places(self, lot: str, places: list) -> None:
+        """Replace places of lot, see `places`."""
+        with self.__transaction() as execute:
+            execute('DELETE FROM shared_places WHERE lot = ?', (lot, ))
+            for position, (number, state, occupant, since,
+                           version) in enumerate(places):
+                execute('INSERT INTO shared_places VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?)',
+                        (lot, number, position, state, occupant,
+                         since.timestamp() if since else None, version))
+            execute(BUMP, (f'lot:{lot}', ))
+
+    def update_place(self, lot: str, place: PlaceSnapshot,
+                     version: int) -> int:
+        """Write changed place if it has version since change.
+
+        Args:
+            lot: parking lot.
+            place: place after change.
+            version: place version before change.
+
+        Returns:
+            int: version of lot after write, None if other process
+            changed place.
+        """
+        since = place.occupy_since
+        with self.__transaction() as execute:
+            cursor = execute(
+                'UPDATE shared_places SET state = ?, occupant = ?, '
+                'since = ?, version = version + 1 '
+                'WHERE lot = ? AND number = ? AND version = ?',
+                (place.state, place.occupant,
+                 since.timestamp() if since else None, lot, place.number,
+                 version))
+            if cursor.rowcount == 0:
+                return None
+            return execute(BUMP + ' RETURNING version',
+                           (f'lot:{lot}', )).fetchone()[0]
+
+    def clear_places(self, lot: str) -> list:
+        """Free all places of lot.
+
+        Returns:
+            list: snapshots of places as they were before clear.
+        """
+        with self.__transaction() as execute:
+            rows = execute(
+                'SELECT number, state, occupant, since FROM shared_places '
+                "WHERE lot = ? AND state != 'free' ORDER BY position",
+                (lot, )).fetchall()
+            if rows:
+                execute("UPDATE shared_places SET state = 'free', "
+                        'occupant = NULL, since = NULL, version = version + 1 '
+                        "WHERE lot = ? AND state != 'free'", (lot, ))
+                execute(BUMP, (f'lot:{lot}', ))
+        return [PlaceSnapshot(number, state, occupant,
+                              datetime.fromtimestamp(since) if since else None)
+                for number, state, occupant, since in rows]
+
+    def users(self) -> dict:
+        """Users names by user id."""
+        with self.__lock:
+            return dict(self.__connection.execute(
+                'SELECT user, name FROM shared_users'))
+
+    def set_user(self, user: str, name: str = None) -> None:
+        """Add or rename user, remove if name is None."""
+        with self.__transaction() as execute:
+            if name is None:
+                execute('DELETE FROM shared_users WHERE user = ?', (user, ))
+            else:
+                execute('INSERT INTO shared_users (user, name) '
+                        'VALUES (?, ?) ON CONFLICT (user) '
+                        'DO UPDATE SET name = excluded.name', (user, name))
+            execute(BUMP, ('users', ))
+
+    def blocked(self) -> set:
+        """Users that blocked the bot."""
+        with self.__lock:
+            return {user for user, in self.__connection.execute(
+                'SELECT user FROM shared_users WHERE blocked')}
+
+    def set_blocked(self, user: str, blocked: bool) -> None:
+        """Mark user as one that blocked the bot or unblocked it."""
+        with self.__transaction() as execute:
+            execute('UPDATE shared_users SET blocked = ? WHERE user = ?',
+                    (int(blocked), user))
+            execute(BUMP, ('users', ))
+
+    def subscribers(self) -> dict:
+        """Sets of users by notification mode by lot."""
+        subscribers = {}
+        with self.__lock:
+            for user, lot, mode in self.__connection.execute(
+                    'SELECT user, lot, mode FROM shared_subscribers'):
+                subscribers.setdefault(lot, {}).setdefault(
+                    mode, set()).add(user)
+        return subscribers
+
+    def set_subscriber(self, user: str, lot: str = None,
+                       mode: str = None) -> None:
+        """Subscribe user to lot, unsubscribe if lot is None."""
+        with self.__transaction() as execute:
+            if lot is None:
+                execute('DELETE FROM shared_subscribers WHERE user = ?',
+                        (user, ))
+            else:
+                execute('INSERT OR REPLACE INTO shared_subscribers '
+                        'VALUES (?, ?, ?)', (user, lot, mode))
+            execute(BUMP, ('subscribers', ))
+
+    def publish(self, key: str, version: int, value: str) -> None:
+        """Share value made by leader (like statistics text)."""
+        with self.__transaction() as execute:
+            execute('INSERT OR REPLACE INTO shared_published '
+                    'VALUES (?, ?, ?)', (key, version, value))
+
+    def published(self, key: str) -> tuple:
+        """Version and value of published key, None if there is none."""
+        with self.__lock:
+            return self.__connection.execute(
+                'SELECT version, value FROM shared_published WHERE key = ?',
+                (key, )).fetchone()
+
+    def post(self, lot: str, kind: str, payload) -> None:
+        """Append change to outbox.
+
+        Args:
+            lot: parking lot.
+            kind: kind of change, defines payload.
+            payload: json serializable change data.
+        """
+        with self.__transaction() as execute:
+            execute('INSERT INTO outbox (lot, kind, payload) VALUES '
+                    '(?, ?, ?)', (lot, kind, dumps(payload,
+                                                   ensure_ascii=False)))
+
+    def take(self, after: int = 0, limit: int = 100) -> list:
+        """First changes of outbox after id as tuples of id, lot, kind
+        and payload, they are removed by `ack`."""
+        with self.__lock:
+            return [(row_id, lot, kind, loads(payload))
+                    for row_id, lot, kind, payload in
+                    self.__connection.execute(
+                        'SELECT id, lot, kind, payload FROM outbox '
+                        'WHERE id > ? ORDER BY id LIMIT ?', (after, limit))]
+
+    def ack(self, last_id: int) -> None:
+        """Remove changes of outbox up to id."""
+        with self.__transaction() as execute:
+            execute('DELETE FROM outbox WHERE id <= ?', (last_id, ))
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """Take or prolong lease, if it's free, expired or ours.
+
+        Args:
+            name: lease name.
+            ttl: seconds lease is held without prolonging.
+
+        Returns:
+            bool: does process hold lease.
+        """
+        now = time()
+        with self.__transaction() as execute:
+            execute('INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) '
+                    'DO UPDATE SET owner = excluded.owner, '
+                    'expires = excluded.expires '
+                    'WHERE owner = excluded.owner OR expires < ?',
+                    (name, self.__owner, now + ttl, now))
+            owner, = execute('SELECT owner FROM leases WHERE name = ?',
+                             (name, )).fetchone()
+        return owner == self.__owner
+
+    def release_lease(self, name: str) -> None:
+        """Give lease up, if it's ours."""
+        with self.__transaction() as execute:
+            execute('DELETE FROM leases WHERE name = ? AND owner = ?',
+                    (name, self.__owner))
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+    def __transaction(self):
+        return Transaction(self.__connection, self.__lock)
+
+
+class Transaction:
+    """Write transaction taking database lock at once, so concurrent
+    writers wait for each other instead of failing on upgrade.
+
+    Attributes:
+        connection: connection in autocommit mode.
+        lock: lock of connection in process.
+    """
+    def __init__(self, connection, lock: Lock) -> None:
+        self.__connection = connection
+        self.__lock = lock
+
+    def __enter__(self):
+        self.__lock.acquire()
+        try:
+            self.__connection.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.__lock.release()
+            raise
+        return self.__connection.execute
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            self.__connection.execute(
+                'COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.__lock.release()
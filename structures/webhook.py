@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import loads
+from queue import Queue
+from threading import Thread
+
+from telegram import Bot, Update
+
+from .metrics import Metrics
+
+MAX_BODY = 1024 * 1024
+"""int: max size of update request body in bytes."""
+
+
+class PoolHTTPServer(HTTPServer):
+    """HTTP server handling requests by fixed pool of threads.
+
+    Attributes:
+        address: host and port to listen.
+        handler: request handler class.
+        workers: number of request handling threads.
+    """
+    request_queue_size = 128
+
+    def __init__(self, address: tuple, handler: type, workers: int) -> None:
+        super().__init__(address, handler)
+        self.__pool = ThreadPoolExecutor(workers,
+                                         thread_name_prefix='webhook')
+
+    def process_request(self, request, address: tuple) -> None:
+        self.__pool.submit(self.__process, request, address)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.__pool.shutdown()
+
+    def __process(self, request, address: tuple) -> None:
+        try:
+            self.finish_request(request, address)
+        except Exception:
+            self.handle_error(request, address)
+        finally:
+            self.shutdown_request(request)
+
+
+class WebhookServer:
+    """Receiver of Telegram updates by webhook.
+
+    Requests are checked by secret token from `set_webhook`, decoded
+    and put to dispatcher update queue, so they are handled by the same
+    handlers as polled updates. Server is plain HTTP, TLS is expected
+    to be terminated by reverse proxy or load balancer.
+
+    Attributes:
+        bot: bot for decoding updates.
+        update_queue: update queue of dispatcher.
+        secret_token: expected X-Telegram-Bot-Api-Secret-Token header.
+        path (optional): URL path of webhook.
+        workers (optional): number of request handling threads.
+        metrics (optional): for counting of received updates.
+    """
+    def __init__(self, bot: Bot, update_queue: Queue, secret_token: str,
+                 path: str = '/', workers: int = 4,
+                 metrics: Metrics = None) -> None:
+        self.__bot = bot
+        self.__update_queue = update_queue
+        self.__secret_token = secret_token
+        self.__path = path
+        self.__workers = workers
+        self.__metrics = metrics or Metrics()
+        self.__server = None
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> None:
+        """Serve webhook requests in background thread."""
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                self.send_response(webhook.receive(
+                    self.path, self.headers, self.rfile))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.__server = PoolHTTPServer((host, port), Handler, self.__workers)
+        Thread(target=self.__server.serve_forever, name='webhook',
+               daemon=True).start()
+
+    def stop(self) -> None:
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def receive(self, path: str, headers: dict, body) -> int:
+        """Check and enqueue update from request.
+
+        Args:
+            path: request path.
+            headers: request headers.
+            body: file-like request body.
+
+        Returns:
+            int: HTTP status of response.
+        """
+        if path != self.__path:
+            return 404
+        token = headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not compare_digest(token.encode(), self.__secret_token.encode()):
+            self.__metrics.inc('webhook_rejected')
+            return 403
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            return 400
+        if length < 0:
+            return 400
+        if length > MAX_BODY:
+            return 413
+        try:
+            data = loads(body.read(length))
+            # Fields of wrong types fail in de_json with any error
+            update = (Update.de_json(data, self.__bot)
+                      if isinstance(data, dict) else None)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if update is None:
+            self.__metrics.inc('webhook_rejected')
+            return 400
+        self.__update_queue.put(update)
+        self.__metrics.inc('webhook_updates')
+        return 200
@@ -0,0 +1,83 @@
+from json import dump
+from logging import getLogger
+from os import fchmod, fsync, remove, replace, stat
+from os.path import abspath, dirname, exists
+from tempfile import NamedTemporaryFile
+from threading import Lock, Timer
+
+logger = getLogger(__name__)
+
+
+class JsonWriter:
+    """Debounced atomic writer of json file.
+
+    Changes are batched: file is written once in `delay` seconds after
+    first change, in background. It's written to temporary file and
+    renamed over the old one (keeping its permissions), so crash never
+    leaves half written file. Data of failed write stays pending and is
+    written by next change or flush.
+
+    Attributes:
+        filename: json file name.
+        delay (optional): seconds to batch changes for.
+    """
+    def __init__(self, filename: str, delay: float = 1.0) -> None:
+        self.__filename = filename
+        self.__delay = delay
+        self.__data = None
+        self.__timer = None
+        self.__lock = Lock()
+        # Writes are made one at a time outside lock of pending data, so
+        # scheduling never waits for disk
+        self.__write_lock = Lock()
+
+    def schedule(self, data: dict) -> None:
+        """Schedule data writing.
+
+        Args:
+            data: data to write, it's copied while writing, so later
+            changes get into the same write.
+        """
+        with self.__lock:
+            self.__data = data
+            if self.__timer is None:
+                self.__timer = Timer(self.__delay, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def flush(self) -> None:
+        """Write pending data right now."""
+        with self.__write_lock:
+            with self.__lock:
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+                if self.__data is None:
+                    return
+                pending, self.__data = self.__data, None
+                data = dict(pending)
+            if not self.__write(data):
+                with self.__lock:
+                    if self.__data is None:
+                        self.__data = pending
+
+    def __write(self, data: dict) -> bool:
+        file = None
+        try:
+            file = NamedTemporaryFile(
+                'w', dir=dirname(abspath(self.__filename)), prefix='.tmp',
+                delete=False)
+            with file:
+                if exists(self.__filename):
+                    fchmod(file.fileno(),
+                           stat(self.__filename).st_mode & 0o7777)
+                dump(data, file, indent=4, sort_keys=True)
+                file.flush()
+                fsync(file.fileno())
+            replace(file.name, self.__filename)
+        except Exception:
+            logger.exception(f'Ошибка записи {self.__filename}')
+            if file is not None and exists(file.name):
+                remove(file.name)
+            return False
+        return True
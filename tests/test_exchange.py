@@ -0,0 +1,23 @@
+from json import dumps
+from unittest import TestCase, main
+
+from structures.exchange import read_stats
+from structures.stats import Stats
+
+
+class ReadStatsTest(TestCase):
+    def test_exported_dict_is_read(self) -> None:
+        stats = Stats({'1': 'User1'})
+        stats.merge({'places': {'1': 2}, 'total_time': 60.0})
+        self.assertEqual(read_stats(dumps(stats.as_dict)), stats.as_dict)
+
+    def test_wrong_dict_is_rejected(self) -> None:
+        stats_dict = Stats({}).as_dict
+        stats_dict['places'] = {'1': -1}
+        for text in ('{', '[]', dumps(stats_dict)):
+            with self.assertRaises(ValueError):
+                read_stats(text)
+
+
+if __name__ == '__main__':
+    main()
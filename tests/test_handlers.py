@@ -0,0 +1,129 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from benchmarks.__main__ import Scenario, load_bot
+from benchmarks.fakes import make_context
+from structures.events import EventLog
+from structures.store import SharedStore
+
+
+def setUpModule() -> None:
+    global bot_module, directory
+    directory = TemporaryDirectory()
+    bot_module = load_bot(directory.name, False)
+
+
+def tearDownModule() -> None:
+    directory.cleanup()
+
+
+class HandlersTest(TestCase):
+    def setUp(self) -> None:
+        self.scenario = Scenario(bot_module, 3, 3, 0)
+        self.bot_data = self.scenario.bot_data
+
+    def test_reserve_is_logged_with_user(self) -> None:
+        log = EventLog(join(directory.name, 'events.sqlite3'))
+        self.bot_data['stats'][''].attach(log)
+        self.scenario.press(2, '/1@0')
+        events = [(action, place, person)
+                  for _, action, place, person, _ in log.events()]
+        log.close()
+        self.assertEqual(events, [('reserve', '1', '2')])
+
+    def test_user_gets_keyboard_in_any_mode(self) -> None:
+        self.bot_data['subscribers'][''] = {
+            'all': {'3'}, 'free': {'1'}, 'off': {'2'}}
+        received = {}
+        make_keyboard = bot_module.make_keyboard
+
+        def record(context, lot, user):
+            markup = make_keyboard(context, lot, user)
+            received[user] = [button.callback_data
+                              for row in markup.inline_keyboard
+                              for button in row]
+            return markup
+
+        with patch.object(bot_module, 'make_keyboard', record):
+            for user, number in ((1, '1'), (2, '2')):
+                data = f'/{number}@'
+                buttons = [button for button, _ in self.scenario.buttons(user)]
+                for _ in range(2):
+                    self.scenario.press(user, next(
+                        button for button in buttons
+                        if button.startswith(data)))
+                    buttons = received.pop(str(user))
+                place = self.bot_data['parking'][''].place(number)
+                self.assertEqual((place.state, place.occupant),
+                                 ('occupied', str(user)))
+
+    def test_charts_are_rendered_before_queueing(self) -> None:
+        log = EventLog(join(directory.name, 'charts.sqlite3'))
+        self.bot_data['stats'][''].attach(log)
+        bot_module.chart_cache.clear()
+        rendered, jobs = [], []
+        make_job = bot_module.make_charts_notification
+        with patch.object(bot_module, 'render_charts',
+                          lambda *args: rendered.append(args) or b'png'), \
+                patch.object(bot_module, 'make_charts_notification',
+                             lambda *args: jobs.append(make_job(*args))):
+            for _ in range(2):
+                self.scenario.press(
+                    1, self.scenario.control_button(1, 'statistics'))
+            self.assertEqual((len(rendered), len(jobs)), (1, 2))
+            bot_module.broadcaster.start(self.scenario.fake)
+            try:
+                for job in jobs:
+                    job()
+            finally:
+                bot_module.broadcaster.stop()
+        log.close()
+        self.assertEqual(len(rendered), 1)
+        self.assertEqual(self.scenario.fake.calls['send_photo'], 2)
+
+
+class SharedTest(TestCase):
+    def setUp(self) -> None:
+        self.scenario = Scenario(bot_module, 3, 3, 0)
+        self.store = SharedStore(join(directory.name, 'shared.sqlite3'), 'a')
+        self.context = make_context(self.scenario.fake,
+                                    self.scenario.bot_data)
+        bot_module.shared_versions.clear()
+
+    def tearDown(self) -> None:
+        self.store.close()
+
+    def test_renamed_user_is_refreshed(self) -> None:
+        bot_module.make_keyboard(self.context, '', '1')
+        self.assertTrue(bot_module.keyboard_cache)
+        self.store.set_user('1', 'Renamed')
+        with patch.object(bot_module, 'store', self.store):
+            bot_module.sync_shared(self.context)
+        stats = self.scenario.bot_data['stats']['']
+        self.assertEqual(bot_module.users['1'], 'Renamed')
+        self.assertEqual(stats.as_dict['users']['1'], 'Renamed')
+        self.assertFalse(bot_module.keyboard_cache)
+
+    def test_edit_mode_is_off(self) -> None:
+        with patch.dict(bot_module.config, edit_messages=True):
+            self.assertTrue(bot_module.edit_mode())
+            with patch.object(bot_module, 'store', self.store):
+                self.assertFalse(bot_module.edit_mode())
+
+
+class ConfigTest(TestCase):
+    def test_wrong_auto_clear_is_rejected(self) -> None:
+        options = {'places': [1], 'auto_clear': '7 am'}
+        with self.assertRaisesRegex(ValueError, 'HH:MM'):
+            bot_module.check_config(options)
+        options['auto_clear'] = '24:00'
+        with self.assertRaisesRegex(ValueError, 'HH:MM'):
+            bot_module.check_config(options)
+        options['auto_clear'] = '03:30'
+        bot_module.check_config(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from structures.events import EventLog
+from structures.parking import Parking
+from structures.stats import Stats
+
+
+class EventLogTest(TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.log = EventLog(join(self.directory.name, 'events.sqlite3'))
+        self.stats = Stats({'1': 'User1'})
+        self.stats.attach(self.log)
+        self.parking = Parking(['1'])
+
+    def tearDown(self) -> None:
+        self.log.close()
+        self.directory.cleanup()
+
+    def test_reserve_is_logged_with_user(self) -> None:
+        place, _ = self.parking.toggle_state('1', '1')
+        self.stats.count(place, '1')
+        place, _ = self.parking.toggle_state('1', '1')
+        self.stats.count(place)
+        events = [(action, person)
+                  for _, action, _, person, _ in self.log.events()]
+        self.assertEqual(events, [('reserve', '1'), ('occupy', '1')])
+
+
+if __name__ == '__main__':
+    main()
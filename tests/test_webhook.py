@@ -0,0 +1,29 @@
+from io import BytesIO
+from queue import Queue
+from unittest import TestCase, main
+
+from structures.webhook import WebhookServer
+
+
+class WebhookTest(TestCase):
+    def setUp(self) -> None:
+        self.queue = Queue()
+        self.server = WebhookServer(None, self.queue, 'secret')
+
+    def receive(self, length: str, body: bytes = b'{}') -> int:
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'secret',
+                   'Content-Length': length}
+        return self.server.receive('/', headers, BytesIO(body))
+
+    def test_negative_length_is_rejected(self) -> None:
+        self.assertEqual(self.receive('-1'), 400)
+        self.assertTrue(self.queue.empty())
+
+    def test_wrong_secret_is_rejected(self) -> None:
+        status = self.server.receive('/', {'Content-Length': '2'},
+                                     BytesIO(b'{}'))
+        self.assertEqual(status, 403)
+
+
+if __name__ == '__main__':
+    main()